@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for bot.py.
+
+Runs the real download, playlist, playback and HTTP code paths against
+local stand-ins: fake ``yt_dlp``/``gtts`` modules and fake ``ffmpeg``,
+``ffprobe``, ``spotdl`` and ``yt-dlp`` executables (bench/fakes), plus a
+fake voice client that consumes audio frames in real time. No Discord
+connection or network access is needed.
+
+    python bench/bench.py [--tracks 4] [--http-seconds 5] [--concurrency 16]
+
+Fake latencies are set with BENCH_* environment variables (see
+bench/fakes/fakeaudio.py).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+FAKES = os.path.join(HERE, 'fakes')
+
+
+def setup_environment(download_dir: str):
+    """Put the fakes first on PATH/PYTHONPATH (workers inherit them) before importing bot."""
+    os.environ['PATH'] = os.path.join(FAKES, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [FAKES, os.environ.get('PYTHONPATH')]))
+    os.environ['DOWNLOAD_DIR'] = download_dir
+    os.environ.setdefault('HTTP_AUTH_USER', 'bench')
+    os.environ.setdefault('HTTP_AUTH_PASS', 'bench')
+    sys.path[:0] = [FAKES, ROOT]
+
+    # the fake voice client never encodes, so libopus is optional here
+    import ctypes.util
+    import discord.opus
+    if not ctypes.util.find_library('opus'):
+        find_library = ctypes.util.find_library
+        ctypes.util.find_library = lambda name: 'opus' if name == 'opus' else find_library(name)
+        discord.opus.load_opus = lambda name: None
+        discord.opus.is_loaded = lambda: True
+
+
+# ---- Fake Discord objects ----
+class FakeChannel:
+    def __init__(self, channel_id: int, name: str):
+        self.id = channel_id
+        self.name = name
+        self.bitrate = 128000
+
+
+class FakeVoiceClient:
+    """Plays sources like discord's AudioPlayer: one read per 20 ms frame."""
+
+    FRAME = 0.02
+
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+        self.source = None
+        self.plays: list[dict] = []
+        self.frames: list[float] = []     # when each audio frame was sent
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._resumed = threading.Event()
+        self._end = threading.Event()
+
+    def play(self, source, *, after=None, **kwargs):
+        if self.is_playing():
+            raise RuntimeError("Already playing audio.")
+        import bot
+        self.source = source
+        self._stop = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._end = threading.Event()
+        args = getattr(getattr(source, '_process', None), 'args', [])
+        record = {'tts': any(str(a).startswith(bot.TTS_DIR) for a in args),
+                  'started': time.monotonic(), 'first_frame': None, 'ended': None, 'frames': 0}
+        self.plays.append(record)
+        self._thread = threading.Thread(target=self._run, args=(source, after, record), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, record):
+        next_at = time.monotonic()
+        error = None
+        try:
+            while not self._stop.is_set():
+                self._resumed.wait()
+                data = source.read()
+                if not data:
+                    break
+                now = time.monotonic()
+                if record['first_frame'] is None:
+                    record['first_frame'] = now
+                record['frames'] += 1
+                self.frames.append(now)
+                next_at += self.FRAME
+                time.sleep(max(0.0, next_at - time.monotonic()))
+        except Exception as e:
+            error = e
+        record['ended'] = time.monotonic()
+        self._end.set()
+        source.cleanup()
+        if after:
+            after(error)
+
+    def is_playing(self) -> bool:
+        return bool(self._thread and not self._end.is_set() and self._resumed.is_set())
+
+    def is_paused(self) -> bool:
+        return bool(self._thread and not self._end.is_set() and not self._resumed.is_set())
+
+    def is_connected(self) -> bool:
+        return True
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def stop(self):
+        self._stop.set()
+        self._resumed.set()
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.voice_channels = [FakeChannel(guild_id * 10, 'General')]
+        self.voice_client = None
+
+    def get_channel(self, channel_id: int):
+        return next((c for c in self.voice_channels if c.id == channel_id), None)
+
+
+# ---- Reporting ----
+def pct(values: list[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summary(values: list[float]) -> dict:
+    return {'n': len(values), 'mean': statistics.fmean(values) if values else float('nan'),
+            'p50': pct(values, 50), 'p99': pct(values, 99), 'max': max(values, default=float('nan'))}
+
+
+# ---- Benchmarks ----
+async def bench_downloads(bot, count: int) -> dict:
+    """Resolve + background download of distinct tracks, then cached replays."""
+    resolve, download, cached = [], [], []
+    for i in range(count):
+        url = f"https://www.youtube.com/watch?v=dl{i:09d}"
+        t = time.monotonic()
+        song = await bot.download_audio(url)
+        resolve.append(time.monotonic() - t)
+        if song.download:
+            await song.download
+        download.append(time.monotonic() - t)
+    for i in range(count):
+        t = time.monotonic()
+        await bot.download_audio(f"https://www.youtube.com/watch?v=dl{i:09d}")
+        cached.append(time.monotonic() - t)
+    t = time.monotonic()
+    await bot.download_audio("https://open.spotify.com/track/benchspotify0001")
+    spotify = time.monotonic() - t
+    return {'resolve': summary(resolve), 'download': summary(download),
+            'cache_hit': summary(cached), 'spotify_download': spotify}
+
+
+async def bench_playback(bot, guild: FakeGuild, tracks: int) -> dict:
+    """Time to first audio and silence between tracks through playback_loop."""
+    player = bot.get_player(guild.id)
+    vc = FakeVoiceClient(guild.voice_channels[0])
+    guild.voice_client = player.voice_client = vc
+    requested = time.monotonic()
+    await bot.add_and_play(player, "https://www.youtube.com/watch?v=play0000000")
+    for i in range(1, tracks):
+        await bot.add_and_play(player, f"https://www.youtube.com/watch?v=play{i:07d}")
+    deadline = time.monotonic() + tracks * (bot_track_seconds() + 30)
+    while time.monotonic() < deadline:
+        if len(player.history) >= tracks and player.current is None:
+            break
+        await asyncio.sleep(0.05)
+    songs = [p for p in vc.plays if not p['tts']]
+    if not songs or songs[0]['first_frame'] is None:
+        raise RuntimeError("no audio was played")
+    # every frame past the first should follow its predecessor by one frame time
+    frames = [f for f in vc.frames if f >= songs[0]['first_frame']]
+    silence = [b - a - vc.FRAME for a, b in zip(frames, frames[1:]) if b - a > 1.5 * vc.FRAME]
+    if player.playback_task:
+        player.playback_task.cancel()
+    return {'time_to_first_audio': songs[0]['first_frame'] - requested,
+            'plays': len(vc.plays), 'silence': summary(silence),
+            'silence_total': sum(silence)}
+
+
+async def bench_playlist(bot, guild: FakeGuild) -> dict:
+    """Playlist listing and ingest throughput (no voice client)."""
+    player = bot.get_player(guild.id)
+    t = time.monotonic()
+    job = await bot.add_playlist(player, "https://www.youtube.com/playlist?list=bench")
+    first_page = time.monotonic() - t
+    await job.expansion
+    total = time.monotonic() - t
+    bot.stop_expansions(player)
+    return {'entries': len(job.songs), 'first_page_s': first_page, 'total_s': total,
+            'entries_per_s': len(job.songs) / total if total else float('nan')}
+
+
+async def bench_http(bot, guild: FakeGuild, seconds: float, concurrency: int) -> dict:
+    """Control API throughput and latency for /api/queue."""
+    from aiohttp import ClientSession, web
+    runner = web.AppRunner(bot.make_http_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f"http://127.0.0.1:{port}/api/queue?guild={guild.id}"
+    headers = {'Authorization': bot.AUTH_HEADER}
+    latencies: list[float] = []
+    errors = 0
+    stop_at = time.monotonic() + seconds
+
+    async def client(session):
+        nonlocal errors
+        while time.monotonic() < stop_at:
+            t = time.monotonic()
+            async with session.get(url, headers=headers) as r:
+                await r.read()
+                if r.status != 200:
+                    errors += 1
+            latencies.append(time.monotonic() - t)
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    await runner.cleanup()
+    return {'requests': len(latencies), 'errors': errors,
+            'requests_per_s': len(latencies) / seconds, 'latency': summary(latencies)}
+
+
+def bot_track_seconds() -> float:
+    import fakeaudio
+    return fakeaudio.TRACK_SECONDS
+
+
+def print_report(results: dict):
+    def ms(v: float) -> str:
+        return f"{v * 1000:8.1f} ms"
+
+    d = results['downloads']
+    print("downloads")
+    print(f"  resolve          p50 {ms(d['resolve']['p50'])}   p99 {ms(d['resolve']['p99'])}")
+    print(f"  full download    p50 {ms(d['download']['p50'])}   p99 {ms(d['download']['p99'])}")
+    print(f"  cache hit        p50 {ms(d['cache_hit']['p50'])}   p99 {ms(d['cache_hit']['p99'])}")
+    print(f"  spotify download     {ms(d['spotify_download'])}")
+    p = results['playback']
+    print("playback")
+    print(f"  time to first audio  {ms(p['time_to_first_audio'])}")
+    print(f"  silences             {p['silence']['n']}, longest {ms(p['silence']['max'])}, "
+          f"total {ms(p['silence_total'])}")
+    pl = results['playlist']
+    print("playlist ingest")
+    print(f"  {pl['entries']} entries, first page {ms(pl['first_page_s'])}, "
+          f"{pl['entries_per_s']:.0f} entries/s")
+    h = results['http']
+    print("control API (/api/queue)")
+    print(f"  {h['requests_per_s']:.0f} req/s, p50 {ms(h['latency']['p50'])}, "
+          f"p99 {ms(h['latency']['p99'])}, {h['errors']} errors")
+
+
+async def run(args) -> dict:
+    import bot
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    bot.bot.loop = asyncio.get_running_loop()
+    os.makedirs(bot.STATE_DIR, exist_ok=True)      # as on_ready does
+    await bot.ytdl_pool.start()
+    if bot.DEBUG_ARCHIVE:
+        bot.start_archive_workers()
+    if bot.NORMALIZE:
+        bot.start_loudness_workers()
+    if bot.OPUS_LADDER:
+        bot.start_ladder_workers()
+    guilds = [FakeGuild(1001, 'Bench playback'), FakeGuild(1002, 'Bench playlist')]
+    for g in guilds:
+        bot.bot._connection._guilds[g.id] = g
+
+    results = {}
+    results['downloads'] = await bench_downloads(bot, args.downloads)
+    results['playback'] = await bench_playback(bot, guilds[0], args.tracks)
+    results['playlist'] = await bench_playlist(bot, guilds[1])
+    results['http'] = await bench_http(bot, guilds[0], args.http_seconds, args.concurrency)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--downloads', type=int, default=5, help="distinct tracks to download")
+    parser.add_argument('--tracks', type=int, default=4, help="tracks to play back to back")
+    parser.add_argument('--http-seconds', type=float, default=5.0)
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent API clients")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's debug logging")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='musicbot-bench-') as tmp:
+        setup_environment(tmp)
+        results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Synthetic audio shared by the benchmark fakes.
+
+A "track" is a small JSON file ({"fake_audio": true, "duration": ...})
+instead of real media; fake stream URLs look like
+``fake://<id>?duration=<seconds>``. The fake ffmpeg turns either into the
+right number of silent PCM bytes or Opus packets.
+"""
+import json
+import os
+import re
+import struct
+
+SAMPLE_RATE = 48000
+PCM_BYTES_PER_SEC = SAMPLE_RATE * 2 * 2      # s16le stereo
+OPUS_FRAMES_PER_SEC = 50                      # 20 ms packets
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+TRACK_SECONDS = env_float('BENCH_TRACK_SECONDS', 3.0)
+RESOLVE_DELAY = env_float('BENCH_RESOLVE_DELAY', 0.2)
+DOWNLOAD_DELAY = env_float('BENCH_DOWNLOAD_DELAY', 1.0)
+PLAYLIST_SIZE = int(env_float('BENCH_PLAYLIST_SIZE', 1000))
+PAGE_DELAY = env_float('BENCH_PAGE_DELAY', 0.05)      # per 100 playlist entries
+SPOTIFY_DELAY = env_float('BENCH_SPOTIFY_DELAY', 2.0)
+SPOTIFY_LIST_SIZE = int(env_float('BENCH_SPOTIFY_LIST_SIZE', 20))
+
+
+def write_track(path: str, duration: float = TRACK_SECONDS, **extra):
+    with open(path, 'w') as f:
+        json.dump({'fake_audio': True, 'duration': duration, **extra}, f)
+
+
+def track_duration(source: str) -> float:
+    """Duration of a fake file or fake:// URL; 0 if it isn't one."""
+    m = re.search(r'duration=([\d.]+)', source)
+    if source.startswith('fake://'):
+        return float(m.group(1)) if m else TRACK_SECONDS
+    try:
+        with open(source) as f:
+            return float(json.load(f).get('duration', 0))
+    except (OSError, ValueError):
+        return 0.0
+
+
+def ogg_page(packets: list[bytes], pagenum: int) -> bytes:
+    """An Ogg page discord.py's parser accepts (it doesn't check the CRC)."""
+    segtable = b''
+    for p in packets:
+        segtable += b'\xff' * (len(p) // 255) + bytes([len(p) % 255])
+    header = b'OggS' + struct.pack('<xBQIIIB', 0, 0, 1, pagenum, 0, len(segtable))
+    return header + segtable + b''.join(packets)
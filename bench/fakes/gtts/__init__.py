@@ -0,0 +1,18 @@
+"""Fake gTTS for benchmarks: writes a synthetic clip sized by the text."""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fakeaudio  # noqa: E402
+
+TTS_DELAY = fakeaudio.env_float('BENCH_TTS_DELAY', 0.3)
+
+
+class gTTS:
+    def __init__(self, text: str, lang: str = 'en'):
+        self.text = text
+
+    def save(self, path: str):
+        time.sleep(TTS_DELAY)
+        fakeaudio.write_track(path, 0.3 * len(self.text.split()))
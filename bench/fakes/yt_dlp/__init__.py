@@ -0,0 +1,74 @@
+"""
+Fake yt_dlp for benchmarks: the subset of YoutubeDL that bot.py and
+ytdl_worker.py use, answering from synthetic data after configurable
+delays (see fakeaudio).
+"""
+import hashlib
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fakeaudio  # noqa: E402
+
+
+def video_id(query: str) -> str:
+    m = re.search(r'(?:v=|youtu\.be/)([\w-]{11})', query)
+    if m:
+        return m.group(1)
+    return hashlib.sha1(query.encode()).hexdigest()[:11]
+
+
+class YoutubeDL:
+    def __init__(self, params: dict | None = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def info(self, query: str) -> dict:
+        vid = video_id(query)
+        duration = fakeaudio.TRACK_SECONDS
+        return {
+            'id': vid,
+            'title': f"Track {vid}",
+            'uploader': "Bench Channel",
+            'duration': duration,
+            'ext': 'fake',
+            'acodec': 'pcm_s16le',
+            'abr': 1536,
+            'format_id': 'fake',
+            'extractor_key': 'Youtube',
+            'webpage_url': f"https://www.youtube.com/watch?v={vid}",
+            'url': f"fake://{vid}?duration={duration}",
+            'http_headers': {},
+        }
+
+    def playlist(self, url: str):
+        for start in range(0, fakeaudio.PLAYLIST_SIZE, 100):
+            time.sleep(fakeaudio.PAGE_DELAY)      # one listing page
+            for i in range(start, min(start + 100, fakeaudio.PLAYLIST_SIZE)):
+                yield {'_type': 'url', 'url': f"https://www.youtube.com/watch?v={i:011d}"}
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True) -> dict:
+        if 'list=' in url:
+            return {'_type': 'playlist', 'id': 'fakelist', 'entries': self.playlist(url)}
+        time.sleep(fakeaudio.RESOLVE_DELAY)
+        info = self.info(url)
+        if download:
+            path = self.params.get('outtmpl', '%(id)s.%(ext)s') % info
+            hooks = self.params.get('progress_hooks', [])
+            steps = 10
+            for n in range(1, steps + 1):
+                time.sleep(fakeaudio.DOWNLOAD_DELAY / steps)
+                for hook in hooks:
+                    hook({'status': 'downloading', 'downloaded_bytes': n, 'total_bytes': steps})
+            fakeaudio.write_track(path, info['duration'])
+            info['requested_downloads'] = [{'filepath': path}]
+        if not url.startswith('http'):
+            return {'_type': 'playlist', 'entries': [info]}     # search results
+        return info
@@ -5,16 +5,28 @@ import uuid
 import asyncio
 import logging
 import base64
+import contextlib
 import re
 import json
+import hashlib
+import gzip
+import hmac
+import audioop
+import itertools
+import random
+import threading
+import shlex
+import shutil
+import sqlite3
 import subprocess
 import time
+import traceback
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Callable, Iterator
 from datetime import datetime, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import threading
-import urllib.parse
 
 import discord
+from aiohttp import web
 from discord.ext import commands, tasks
 import yt_dlp
 from gtts import gTTS
@@ -50,12 +62,63 @@ if DEBUG_ARCHIVE:
     ARCHIVE_ROOT = os.path.join(DOWNLOAD_DIR, "_archive")
     RAW_DIR      = os.path.join(ARCHIVE_ROOT, "raw")   # bit-perfect from yt-dl/spotDL
     ENC_DIR      = os.path.join(ARCHIVE_ROOT, "enc")   # single ffmpeg encode
+    META_DIR     = os.path.join(ARCHIVE_ROOT, "meta")  # title/uploader per archived track
     os.makedirs(RAW_DIR, exist_ok=True)
     os.makedirs(ENC_DIR, exist_ok=True)
+    os.makedirs(META_DIR, exist_ok=True)
+ARCHIVE_WORKERS = max(1, int(os.environ.get('ARCHIVE_WORKERS', '1')))
 # -------------------------------------------------------------------
 
 HTTP_CONTROL_PORT = int(os.environ.get('HTTP_CONTROL_PORT', '8080'))
+BOT_SHARDED = os.environ.get('BOT_SHARDED', '0') == '1'
 FILE_RETENTION_HOURS = int(os.environ.get('FILE_RETENTION_HOURS', '24'))
+CACHE_MAX_MB = int(os.environ.get('CACHE_MAX_MB', '4096'))
+CACHE_INDEX = os.path.join(DOWNLOAD_DIR, 'cache_index.json')
+STATE_DIR = os.path.join(DOWNLOAD_DIR, '_state')
+STATE_SAVE_DELAY = 1.0    # seconds to batch state changes into one journal write
+STATE_HISTORY = 20        # history entries kept across restarts
+PROBE_INDEX = os.path.join(DOWNLOAD_DIR, 'probe_index.json')
+NORMALIZE = os.environ.get('NORMALIZE', '1') != '0'
+LOUDNESS_TARGET = float(os.environ.get('LOUDNESS_TARGET', '-16'))   # LUFS
+LOUDNESS_WORKERS = max(1, int(os.environ.get('LOUDNESS_WORKERS', '1')))
+# Opus bitrates (kbps) every cached track is pre-encoded to; empty turns it off
+OPUS_LADDER = sorted(int(k) for k in os.environ.get('OPUS_LADDER', '96,128,192,256,384').split(',')
+                     if k.strip())
+LADDER_DIR = os.path.join(DOWNLOAD_DIR, '_ladder')
+LIBRARY_DB = os.path.join(DOWNLOAD_DIR, 'library.db')
+SPOTIFY_DIR = os.path.join(DOWNLOAD_DIR, '_spotify')   # spotDL runs write here first
+LIBRARY_FIRST = os.environ.get('LIBRARY_FIRST', '1') != '0'   # answer /play from disk
+LIBRARY_RESULTS = 10      # matches listed by /library search and /api/library
+SPOTIFY_FORMAT = os.environ.get('SPOTIFY_FORMAT', 'mp3')     # spotDL --format
+SPOTIFY_BATCH = max(1, int(os.environ.get('SPOTIFY_BATCH', '10')))   # tracks per spotDL run
+SPOTIFY_CONCURRENCY = max(1, int(os.environ.get('SPOTIFY_CONCURRENCY', '2')))
+SPOTIFY_TIMEOUT = 300     # seconds per track in a spotDL run
+STREAM_MODE = os.environ.get('STREAM_MODE', '1') != '0'
+YTDL_WORKERS = max(1, int(os.environ.get('YTDL_WORKERS', '2')))
+YTDL_TIMEOUT = int(os.environ.get('YTDL_TIMEOUT', '300'))         # whole job, seconds
+YTDL_STALL_TIMEOUT = int(os.environ.get('YTDL_STALL_TIMEOUT', '30'))   # no progress, seconds
+LOOP_STALL_MS = int(os.environ.get('LOOP_STALL_MS', '250'))     # log loop blocks longer than this
+TRACE_SLOW_MS = int(os.environ.get('TRACE_SLOW_MS', '1000'))    # keep spans slower than this
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', '1000'))
+QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL', str(6 * 3600)))   # seconds
+PLAYLIST_CONCURRENCY = max(1, int(os.environ.get('PLAYLIST_CONCURRENCY', '3')))   # per guild
+DOWNLOAD_SLOTS = max(1, int(os.environ.get('DOWNLOAD_SLOTS', '3')))   # shared lookahead, all guilds
+PLAYLIST_PAGE = max(1, int(os.environ.get('PLAYLIST_PAGE', '50')))
+PREFETCH_AHEAD = max(1, int(os.environ.get('PREFETCH_AHEAD', '3')))
+QUEUE_LIMIT = int(os.environ.get('QUEUE_LIMIT', '10000'))
+QUEUE_PAGE = 20           # entries per /queue page and in the API state
+VOLUME_RAMP_MS = int(os.environ.get('VOLUME_RAMP_MS', '100'))
+PREWARM_S = float(os.environ.get('PREWARM_S', '5'))        # open the next track this early
+CROSSFADE_MS = int(os.environ.get('CROSSFADE_MS', '0'))    # 0 = straight cut between tracks
+IDLE_CHECK_S = 30         # an idle player rechecks its voice connection this often
+VOLUME_COALESCE_MS = int(os.environ.get('VOLUME_COALESCE_MS', '50'))
+# /api/ws batches player changes for this long before pushing a delta
+STREAM_COALESCE_MS = int(os.environ.get('STREAM_COALESCE_MS', '100'))
+STREAM_RESYNC_S = 15      # re-diff idle streams to catch guild/channel changes
+STREAM_DRIFT_S = 1.0      # resend position when client extrapolation is this far off
+TTS_ENGINE = os.environ.get('TTS_ENGINE', 'gtts')
+TTS_DIR = os.path.join(DOWNLOAD_DIR, '_tts')
+TTS_CACHE_CLIPS = int(os.environ.get('TTS_CACHE_CLIPS', '500'))
 AUTH_USER = os.environ.get('HTTP_AUTH_USER', 'admin')
 AUTH_PASS = os.environ.get('HTTP_AUTH_PASS', 'secret')
 
@@ -72,29 +135,368 @@ if not which('ffmpeg'):
     sys.exit(1)
 if not which('spotdl'):
     log.warning("spotdl not found; Spotify support will not work")
+if TTS_ENGINE not in ('gtts', 'espeak'):
+    log.error(f"Unknown TTS_ENGINE {TTS_ENGINE!r}; use 'gtts' or 'espeak'")
+    sys.exit(1)
 
 # ---- Bot setup ----
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+# AutoShardedBot lets one process serve many guilds across shards
+bot_class = commands.AutoShardedBot if BOT_SHARDED else commands.Bot
+bot = bot_class(command_prefix='!', intents=intents)
 
 # ---- Shared state ----
-downloads_in_progress: dict[str, datetime] = {}
-last_channel_id: int | None = None
-playback_task: asyncio.Task | None = None
-last_playlist_files: set[str] = set()
+downloads_in_progress: dict[str, datetime] = {}   # downloads no guild asked for
+
+# ---- Metrics ----
+# A small Prometheus text-format registry; scraped from /metrics.
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: dict[tuple[str, ...], object] = {}
+        METRICS.append(self)
+
+    def label_text(self, values: tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        return super().render() + [
+            f"{self.name}{self.label_text(k)} {v}" for k, v in self.values.items()
+        ]
+
+class Gauge(Metric):
+    """Read at scrape time from ``collect``, which returns {labels: value}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...],
+                 collect: Callable[[], dict[tuple[str, ...], float]]):
+        super().__init__(name, doc, labels)
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        return super().render() + [
+            f"{self.name}{self.label_text(k)} {v}" for k, v in self.collect().items()
+        ]
+
+class Histogram(Metric):
+    kind = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def observe(self, value: float, *labels: str):
+        counts = self.values.get(labels)
+        if counts is None:
+            # per-bucket counts, then sum and count
+            counts = self.values[labels] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def timer(self, *labels: str) -> 'HistogramTimer':
+        return HistogramTimer(self, labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for labels, counts in self.values.items():
+            for bound, n in zip(self.BUCKETS + ('+Inf',), counts[:-2] + [counts[-1]]):
+                le = self.label_text(labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {n}")
+            lines.append(f"{self.name}_sum{self.label_text(labels)} {counts[-2]}")
+            lines.append(f"{self.name}_count{self.label_text(labels)} {counts[-1]}")
+        return lines
+
+class HistogramTimer:
+    """``with histogram.timer(...)`` observes the block's wall time."""
+
+    def __init__(self, histogram: Histogram, labels: tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, *self.labels)
+
+METRICS: list[Metric] = []
+
+def render_metrics() -> str:
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+resolve_seconds = Histogram(
+    'musicbot_resolve_seconds', 'Time to resolve a query to a stream URL.', ('source',))
+download_seconds = Histogram(
+    'musicbot_download_seconds', 'Time to download a track.', ('source',))
+first_audio_seconds = Histogram(
+    'musicbot_request_to_audio_seconds', 'Time from a play request to its audio starting.')
+track_gap_seconds = Histogram(
+    'musicbot_track_gap_seconds', 'Silence between one track ending and the next starting.')
+tts_seconds = Histogram(
+    'musicbot_tts_render_seconds', 'Time to render a TTS clip.', ('engine',))
+http_seconds = Histogram(
+    'musicbot_http_request_seconds', 'HTTP control request latency.', ('endpoint',))
+spawns = Counter(
+    'musicbot_process_spawns_total', 'External processes started.', ('program',))
+cache_requests = Counter(
+    'musicbot_cache_requests_total', 'Cache lookups.', ('cache', 'result'))
+loudness_seconds = Histogram(
+    'musicbot_loudness_analysis_seconds', 'Time to measure the loudness of a cached track.')
+ladder_seconds = Histogram(
+    'musicbot_ladder_encode_seconds', 'Time to encode the Opus ladder of a cached track.')
+Gauge('musicbot_queue_depth', 'Songs queued per guild.', ('guild',),
+      lambda: {(str(gid),): len(p.queue) for gid, p in players.items()})
+Gauge('musicbot_downloads_active', 'Downloads in progress.', (),
+      lambda: {(): len(downloads_in_progress) + sum(len(p.downloads) for p in players.values())})
+
+def source_label(query: str) -> str:
+    if SPOTIFY_TRACK_RE.search(query):
+        return 'spotify'
+    if is_search(query):
+        return 'search'
+    return 'youtube' if YOUTUBE_ID_RE.search(query) else 'other'
+
+# ---- Diagnostics ----
+# A watchdog thread notices when the event loop stops answering and logs
+# what it is stuck in; slash commands and HTTP calls are recorded as spans.
+loop_lag_seconds = Histogram(
+    'musicbot_loop_lag_seconds', 'How late the event loop ran a scheduled heartbeat.')
+
+class LoopWatchdog:
+    """Heartbeat on the loop, checked from a thread that can see its stack."""
+
+    def __init__(self, threshold: float, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread: int | None = None
+        self.last_beat = time.monotonic()
+        self.stalls: deque[dict] = deque(maxlen=50)
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        loop.call_soon(self.beat, self.last_beat + self.interval)
+        threading.Thread(target=self.watch, name='loop-watchdog', daemon=True).start()
+
+    def beat(self, due: float):
+        now = time.monotonic()
+        lag = max(0.0, now - due)
+        loop_lag_seconds.observe(lag)
+        if lag >= self.threshold and self.stalls and 'duration' not in self.stalls[-1]:
+            self.stalls[-1]['duration'] = round(lag, 3)     # the stall's full length
+        self.last_beat = now
+        self.loop.call_later(self.interval, self.beat, now + self.interval)
+
+    def watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self.last_beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat                 # one report per stall
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            self.stalls.append({'at': time.time(), 'stalled': round(stalled, 3), 'stack': stack})
+            log.warning(f"Event loop blocked for {stalled * 1000:.0f} ms in:\n{stack}")
+
+class SpanLog:
+    """Recent command/API spans, with the slow ones kept longer."""
+
+    def __init__(self, slow: float):
+        self.slow = slow
+        self.recent: deque[dict] = deque(maxlen=200)
+        self.slow_spans: deque[dict] = deque(maxlen=100)
+
+    def record(self, kind: str, name: str, started: float, error: str | None = None,
+               **attrs):
+        duration = time.time() - started
+        span = {'kind': kind, 'name': name, 'start': started,
+                'duration': round(duration, 4), 'error': error, **attrs}
+        # loop stalls inside the span usually explain a slow one
+        span['stalls'] = [s['stalled'] for s in watchdog.stalls if s['at'] >= started]
+        self.recent.append(span)
+        if duration >= self.slow:
+            self.slow_spans.append(span)
+
+watchdog = LoopWatchdog(LOOP_STALL_MS / 1000)
+spans = SpanLog(TRACE_SLOW_MS / 1000)
 
 # ---- Song & Player ----
 class Song:
-    def __init__(self, title: str, filepath: str, query: str, duration: float = 0.0):
+    def __init__(self, title: str, filepath: str, query: str, duration: float = 0.0,
+                 key: str | None = None):
         self.title = title
         self.filepath = filepath
         self.query = query
         self.duration = duration  # seconds
+        self.key = key            # track cache key, e.g. "youtube:<id>"
+        self.codec: str | None = None    # source audio codec as reported by yt-dlp
+        self.abr: float | None = None    # source audio bitrate in kbps
+        self.stream_url: str | None = None     # direct media URL while streaming
+        self.http_headers: dict[str, str] = {}
+        self.download: asyncio.Task | None = None   # background download of filepath
+        self.streaming = False
+        self.streaming_failed = False
+        # queue entries start out 'pending' and are resolved by the prefetcher
+        self.status = 'ready'     # pending -> downloading -> ready | failed
+        self.error: str | None = None
+        self.prefetch: asyncio.Task | None = None
+        self.entry_id: int | None = None    # set by TrackQueue while queued
+        self.resume_at = 0.0      # start offset when restored mid-track
+        self.requested_at: float | None = None   # monotonic time of a /play request
+        self.origin: str | None = None
+        self.uploader: str | None = None
+
+    @classmethod
+    def pending(cls, query: str) -> 'Song':
+        """A queue entry that hasn't been resolved or downloaded yet."""
+        m = SPOTIFY_TRACK_RE.search(query)
+        listed = m and spotify_listed.get(m.group(1)) or {}   # known from an album listing
+        song = cls(listed.get('title') or query, '', query, listed.get('duration') or 0.0)
+        song.status = 'pending'
+        return song
+
+    @classmethod
+    def from_library(cls, row: dict, path: str, query: str) -> 'Song':
+        song = cls(row['title'], path, query, row['duration'] or 0.0, row['key'])
+        song.uploader = row['uploader']
+        return song
+
+    @classmethod
+    def from_cache(cls, entry: dict, query: str) -> 'Song':
+        song = cls(entry['title'], entry['path'], query, entry['duration'], entry['key'])
+        song.codec = entry.get('codec')
+        song.abr = entry.get('abr')
+        return song
+
+    def update_from(self, other: 'Song'):
+        for attr in ('title', 'filepath', 'duration', 'key', 'codec', 'abr', 'stream_url',
+                     'http_headers', 'download', 'uploader'):
+            setattr(self, attr, getattr(other, attr))
+
+class DownloadList(dict):
+    """Running downloads (query -> start time) that mark their player as changed."""
+
+    def __init__(self, player: 'MusicPlayer'):
+        super().__init__()
+        self.player = player
+        self.progress: dict[str, float] = {}    # query -> fraction done, when known
+
+    def __setitem__(self, query: str, started: datetime):
+        super().__setitem__(query, started)
+        self.player.touch()
+
+    def pop(self, query: str, default=None):
+        started = super().pop(query, default)
+        self.progress.pop(query, None)
+        self.player.touch()
+        return started
+
+    def report_progress(self, query: str, fraction: float):
+        if query in self:
+            self.progress[query] = fraction
+            self.player.touch()
+
+class TrackQueue:
+    """
+    Upcoming songs in play order. Entries get a stable ID when added, so
+    they can be removed or moved by ID however the queue shifts, and an
+    origin tag (``playlist:<job>``, ``user:<id>``, ...) for bulk removal.
+    Head pops, ID lookups and removals are O(1).
+    """
 
-class MusicPlayer:
     def __init__(self):
-        self.queue: list[Song] = []
+        self.entries: OrderedDict[int, Song] = OrderedDict()
+        self.by_origin: dict[str, set[int]] = {}
+        self.ids = itertools.count(1)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Song]:
+        return iter(self.entries.values())
+
+    def __contains__(self, entry_id: int) -> bool:
+        return entry_id in self.entries
+
+    def append(self, song: Song, origin: str | None = None) -> Song:
+        song.entry_id = next(self.ids)
+        song.origin = origin or song.origin
+        self.entries[song.entry_id] = song
+        if song.origin:
+            self.by_origin.setdefault(song.origin, set()).add(song.entry_id)
+        return song
+
+    def appendleft(self, song: Song, origin: str | None = None) -> Song:
+        self.append(song, origin)
+        self.entries.move_to_end(song.entry_id, last=False)
+        return song
+
+    def popleft(self) -> Song:
+        _, song = self.entries.popitem(last=False)
+        self._untag(song)
+        return song
+
+    def remove(self, entry_id: int) -> Song | None:
+        song = self.entries.pop(entry_id, None)
+        if song:
+            self._untag(song)
+        return song
+
+    def remove_origin(self, origin: str) -> list[Song]:
+        return [self.entries.pop(i) for i in self.by_origin.pop(origin, ())]
+
+    def move(self, entry_id: int, to_front: bool = True) -> bool:
+        if entry_id not in self.entries:
+            return False
+        self.entries.move_to_end(entry_id, last=not to_front)
+        return True
+
+    def head(self, n: int) -> list[Song]:
+        return list(itertools.islice(self.entries.values(), n))
+
+    def page(self, offset: int, limit: int) -> list[Song]:
+        return list(itertools.islice(self.entries.values(), offset, offset + limit))
+
+    def clear(self):
+        self.entries.clear()
+        self.by_origin.clear()
+
+    def _untag(self, song: Song):
+        ids = self.by_origin.get(song.origin)
+        if ids is not None:
+            ids.discard(song.entry_id)
+            if not ids:
+                del self.by_origin[song.origin]
+
+class MusicPlayer:
+    """Queue and playback state of one guild."""
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
         self.history: list[Song] = []
         self.loop = False
         self.loop_queue = False
@@ -106,112 +508,811 @@ class MusicPlayer:
         self.volume: float = 1.0
         self.lock = asyncio.Lock()
         self.paused_pos: float | None = None
-
-    async def add_song(self, query: str) -> Song:
-        if len(self.queue) >= 10:
-            raise RuntimeError('Queue limit reached (10)')
-        song = await download_audio(query)
-        self.queue.append(song)
+        self.play_error: Exception | None = None
+        self.pending_volume: int | None = None
+        self.source: discord.AudioSource | None = None   # the playing track's source
+        self.playback_task: asyncio.Task | None = None
+        self.last_channel_id: int | None = None
+        self.last_playlist: str | None = None    # origin tag of the last playlist
+        self.downloads = DownloadList(self)
+        self.download_slots = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+        self.fetching = 0         # entries of this guild resolving right now
+        self.ingest_jobs: OrderedDict[str, IngestJob] = OrderedDict()
+        self.version = 0          # bumped on every state change the API shows
+        self.state_cache: tuple | None = None
+        self.watchers: set[asyncio.Event] = set()   # one per open state stream
+        self.journal_handle: asyncio.TimerHandle | None = None
+        self.track_ended_at: float | None = None   # for the track-gap metric
+        self.idle = asyncio.Event()     # set while the voice client plays nothing
+        self.idle.set()
+        self.chain: TrackChain | None = None     # the playing PCM chain, if any
+        self.upcoming: UpcomingTrack | None = None   # next track, opened ahead of time
+        self.prewarm_task: asyncio.Task | None = None
+        self.handed_off: Song | None = None      # track the chain switched to
+
+    def touch(self):
+        """Mark the player's visible state as changed."""
+        self.version += 1
+        for event in self.watchers:
+            event.set()
+        if self.upcoming and self.upcoming.song is not self.next_song():
+            discard_upcoming(self)
+
+    def dirty(self):
+        """touch() for a change the journal keeps: queue, track, flags, volume, channel."""
+        self.touch()
+        if not self.journal_handle:
+            self.journal_handle = bot.loop.call_later(STATE_SAVE_DELAY, journal_player, self)
+
+    def next_song(self) -> Song | None:
+        """The song that plays after the current one, as things stand."""
+        if self.loop and self.current:
+            return self.current
+        return next(iter(self.queue), None)
+
+    @property
+    def guild(self) -> discord.Guild | None:
+        return bot.get_guild(self.guild_id)
+
+    async def add_song(self, query: str, origin: str | None = None) -> Song:
+        if len(self.queue) >= QUEUE_LIMIT:
+            raise RuntimeError(f'Queue limit reached ({QUEUE_LIMIT})')
+        song = self.queue.append(Song.pending(query), origin)
+        song.requested_at = time.monotonic()
+        prefetch_ahead(self)
+        self.dirty()
         return song
 
-async def add_and_play(query: str):
-    """Queue a song and start playback if idle."""
-    song = await player.add_song(query)
+# ---- Player registry ----
+players: dict[int, MusicPlayer] = {}
+
+def get_player(guild_id: int) -> MusicPlayer:
+    """Return the guild's player, creating it on first use."""
+    player = players.get(guild_id)
+    if player is None:
+        player = players[guild_id] = MusicPlayer(guild_id)
+    return player
+
+# ---- Player state journal ----
+# Each guild's queue, flags and position are written to STATE_DIR shortly
+# after every change so a restart picks up where playback left off.
+def state_path(guild_id: int) -> str:
+    return os.path.join(STATE_DIR, f"{guild_id}.json")
+
+def journal_entry(song: Song) -> dict:
+    return {'query': song.query, 'title': song.title, 'key': song.key,
+            'duration': song.duration, 'origin': song.origin}
+
+def journal_player(player: MusicPlayer):
+    """Atomically write the player's state file."""
+    player.journal_handle = None
     vc = player.voice_client
-    if not vc or not vc.is_connected():
-        if last_channel_id is not None:
-            await join_channel(last_channel_id)
-            vc = player.voice_client
-        else:
-            channels = list_voice_channels()
-            if channels:
-                first_id = next(iter(channels.keys()))
-                await join_channel(first_id)
-                vc = player.voice_client
-    global playback_task
-    if not playback_task or playback_task.done():
-        playback_task = bot.loop.create_task(playback_loop(None))
+    current = None
+    if player.current:
+        position = (player.paused_pos if player.paused_pos is not None
+                    else time.time() - player.start_time)
+        current = {**journal_entry(player.current), 'position': position}
+    state = {
+        'queue': [journal_entry(s) for s in player.queue],
+        'current': current,
+        'history': [journal_entry(s) for s in player.history[-STATE_HISTORY:]],
+        'loop': player.loop,
+        'loop_queue': player.loop_queue,
+        'volume': player.volume,
+        'last_channel_id': player.last_channel_id,
+        'connected': bool(vc and vc.is_connected()),
+        'last_playlist': player.last_playlist,
+    }
+    path = state_path(player.guild_id)
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"Could not save state for guild {player.guild_id}: {e}")
+
+def restored_song(entry: dict) -> Song:
+    """A queue entry from the journal: ready if its file is cached, else pending."""
+    cached = track_cache.peek(entry['key']) if entry.get('key') else None
+    if cached:
+        song = Song.from_cache(cached, entry['query'])
+    else:
+        song = Song.pending(entry['query'])
+        song.title = entry.get('title') or entry['query']
+        song.duration = entry.get('duration') or 0
+    song.origin = entry.get('origin')
     return song
 
-async def add_playlist(url: str) -> list[Song]:
-    """Download a playlist and queue its tracks."""
-    global last_playlist_files
-    last_playlist_files.clear()
-    with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
-        info = ydl.extract_info(url, download=False)
-    entries = info.get('entries') or []
-    added: list[Song] = []
-    for e in entries:
-        if len(player.queue) >= 10:
-            break
-        track_url = e.get('url') or e.get('webpage_url')
-        if not track_url:
-            continue
-        if not track_url.startswith('http'):
-            track_url = f"https://www.youtube.com/watch?v={track_url}"
+async def restore_player(guild: discord.Guild):
+    """Rebuild a guild's player from its journal and resume playback."""
+    try:
+        with open(state_path(guild.id)) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    player = get_player(guild.id)
+    if player.current or player.queue:
+        return
+    if state.get('current'):
+        song = restored_song(state['current'])
+        song.resume_at = state['current'].get('position') or 0.0
+        player.queue.append(song)
+    for entry in state.get('queue', []):
+        player.queue.append(restored_song(entry))
+    player.history = [restored_song(e) for e in state.get('history', [])]
+    player.loop = state.get('loop', False)
+    player.loop_queue = state.get('loop_queue', False)
+    player.volume = state.get('volume', 1.0)
+    player.last_channel_id = state.get('last_channel_id')
+    player.last_playlist = state.get('last_playlist')
+    prefetch_ahead(player)
+    player.dirty()
+    log.info(f"Restored {len(player.queue)} queued songs for guild {guild.id}")
+    if state.get('connected') and player.last_channel_id is not None:
+        await join_channel(player, player.last_channel_id)
+        if player.queue:
+            start_playback(player)
+
+# ---- Prefetch ----
+download_slots = asyncio.Semaphore(DOWNLOAD_SLOTS)
+
+@contextlib.asynccontextmanager
+async def download_slot(player: MusicPlayer):
+    """
+    Hold one of the guild's PLAYLIST_CONCURRENCY download slots. A guild's
+    first download starts straight away; the rest also wait for one of
+    the DOWNLOAD_SLOTS shared by every guild, so one guild's lookahead
+    can't hold up another guild's next track.
+    """
+    async with player.download_slots:
+        first = not player.fetching
+        player.fetching += 1
         try:
-            song = await player.add_song(track_url)
-            added.append(song)
-            last_playlist_files.add(song.filepath)
-        except RuntimeError:
+            if first:
+                yield
+            else:
+                async with download_slots:
+                    yield
+        finally:
+            player.fetching -= 1
+
+async def resolve_entry(player: MusicPlayer, song: Song):
+    """Resolve and download a pending queue entry in place."""
+    # spotDL runs are batched and bounded by SpotifyBatcher instead
+    spotify = SPOTIFY_TRACK_RE.search(song.query)
+    if spotify and player.queue.head(1) == [song]:
+        spotify_batcher.urgent.add(spotify.group(1))     # about to play
+    async with contextlib.nullcontext() if spotify else download_slot(player):
+        song.status = 'downloading'
+        player.touch()
+        try:
+            done = await download_audio(song.query, player.downloads)
+        except Exception as e:
+            song.status = 'failed'
+            song.error = str(e)
+            player.touch()
+            raise
+    song.update_from(done)
+    song.status = 'ready'
+    player.dirty()
+    # have the announcement ready before the track comes up
+    asyncio.create_task(tts_clip(f"Now playing {song.title}"))
+
+def prefetch(player: MusicPlayer, song: Song) -> asyncio.Task:
+    """Start resolving a queue entry, or return the task already doing it."""
+    if song.prefetch is None:
+        song.prefetch = asyncio.create_task(resolve_entry(player, song))
+        # failures are reported when the entry reaches the head of the queue
+        song.prefetch.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return song.prefetch
+
+def prefetch_ahead(player: MusicPlayer):
+    """
+    Make sure the next PREFETCH_AHEAD queue entries are being fetched. A
+    Spotify entry coming into range brings the Spotify entries up to
+    SPOTIFY_BATCH further along with it, so spotDL gets whole batches.
+    """
+    ahead = player.queue.head(PREFETCH_AHEAD + SPOTIFY_BATCH)
+    batch = SPOTIFY_BATCH if any(song.status == 'pending' and SPOTIFY_TRACK_RE.search(song.query)
+                                 for song in ahead[:PREFETCH_AHEAD]) else 0
+    for i, song in enumerate(ahead):
+        if song.status != 'pending':
+            continue
+        if batch and SPOTIFY_TRACK_RE.search(song.query):
+            batch -= 1
+            prefetch(player, song)
+        elif i < PREFETCH_AHEAD:
+            prefetch(player, song)
+
+class IngestJob:
+    """Per-track progress of one song or playlist request."""
+
+    def __init__(self, source: str, queries: list[str] | None = None):
+        self.id = uuid.uuid4().hex[:8]
+        self.source = source
+        self.origin = f"request:{self.id}"    # queue tag of the job's entries
+        self.queries: list[str] = list(queries or [])
+        self.songs: list[Song] = []
+        self.enqueued = False
+        self.expansion: asyncio.Task | None = None   # playlist pages still loading
+
+    @property
+    def finished(self) -> bool:
+        return self.enqueued and all(s.status in ('ready', 'failed') for s in self.songs)
+
+    def summary(self) -> dict:
+        """Counts only; per-track detail comes from tracks() (/api/job)."""
+        counts = {'ready': 0, 'failed': 0}
+        for s in list(self.songs):
+            if s.status in counts:
+                counts[s.status] += 1
+        return {
+            'id': self.id,
+            'source': self.source,
+            **counts,
+            'total': len(self.queries),
+            'finished': self.finished,
+        }
+
+    def tracks(self, offset: int, limit: int) -> list[dict]:
+        """Status of tracks ``offset`` to ``offset + limit`` of the request."""
+        tracks = [
+            {'query': s.query, 'title': s.title if s.status == 'ready' else None,
+             'status': s.status, 'error': s.error}
+            for s in self.songs[offset:offset + limit]
+        ]
+        if self.enqueued:
+            # whatever didn't fit under QUEUE_LIMIT
+            start = max(offset, len(self.songs))
+            tracks += [
+                {'query': q, 'title': None, 'status': 'skipped', 'error': None}
+                for q in self.queries[start:offset + limit]
+            ]
+        return tracks
+
+def new_ingest_job(player: MusicPlayer, source: str, queries: list[str] | None = None) -> IngestJob:
+    job = IngestJob(source, queries)
+    player.ingest_jobs[job.id] = job
+    while len(player.ingest_jobs) > 20:
+        player.ingest_jobs.popitem(last=False)
+    return job
+
+def ingest(player: MusicPlayer, job: IngestJob, queries: list[str] | None = None,
+           last: bool = True) -> list[Song]:
+    """
+    Append tracks to the queue as pending entries, in order: the job's own
+    queries, or a further page of them. Only the first PREFETCH_AHEAD
+    entries of the queue are downloaded; the rest are fetched as the
+    playhead approaches them. Returns the songs added.
+    """
+    if queries is None:
+        queries = job.queries
+    else:
+        job.queries += queries
+    added = []
+    for query in queries:
+        if len(player.queue) >= QUEUE_LIMIT:
+            last = True
             break
+        added.append(player.queue.append(Song.pending(query), job.origin))
+    job.songs += added
+    job.enqueued = last
+    prefetch_ahead(player)
+    player.dirty()
     return added
 
-async def add_playlist_and_play(url: str) -> list[Song]:
-    """Add playlist tracks and ensure playback starts."""
-    songs = await add_playlist(url)
+def start_playback(player: MusicPlayer, interaction: discord.Interaction | None = None):
+    """Start the guild's playback loop if it isn't already running."""
+    task = player.playback_task
+    if player.voice_client and (not task or task.done()):
+        player.playback_task = bot.loop.create_task(playback_loop(player, interaction))
+
+async def connect_default_channel(player: MusicPlayer):
+    """Join the last used voice channel, or the first one, if not connected."""
     vc = player.voice_client
-    if not vc or not vc.is_connected():
-        if last_channel_id is not None:
-            await join_channel(last_channel_id)
-            vc = player.voice_client
+    if vc and vc.is_connected():
+        return
+    if player.last_channel_id is not None:
+        await join_channel(player, player.last_channel_id)
+    else:
+        channels = list_voice_channels(player.guild)
+        if channels:
+            await join_channel(player, next(iter(channels.keys())))
+
+async def add_and_play(player: MusicPlayer, query: str, job: IngestJob | None = None) -> Song | None:
+    """Queue a song and start playback if idle."""
+    job = job or new_ingest_job(player, query, [query])
+    songs = ingest(player, job)
+    for song in songs:
+        song.requested_at = time.monotonic()
+    await connect_default_channel(player)
+    start_playback(player)
+    return songs[0] if songs else None
+
+def list_playlist(url: str, start: int, end: int | None, stop: threading.Event,
+                  emit: Callable[[list[str] | BaseException | None], None]):
+    """
+    Walk a playlist's entries with yt-dlp (in a worker thread), handing
+    track URLs to ``emit`` a page at a time as yt-dlp fetches them, then
+    None. ``start``/``end`` are 1-based and inclusive.
+    """
+    try:
+        with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
+            # process=False keeps 'entries' lazy, so pages are fetched on demand
+            info = ydl.extract_info(url, download=False, process=False)
+            entries = info.get('entries') or []
+            page = []
+            for e in itertools.islice(entries, start - 1, end):
+                if stop.is_set():
+                    return
+                if not e:
+                    continue
+                track_url = e.get('url') or e.get('webpage_url')
+                if not track_url:
+                    continue
+                if not track_url.startswith('http'):
+                    track_url = f"https://www.youtube.com/watch?v={track_url}"
+                page.append(track_url)
+                if len(page) >= PLAYLIST_PAGE:
+                    emit(page)
+                    page = []
+            if page:
+                emit(page)
+        emit(None)
+    except BaseException as e:
+        emit(e)
+
+async def playlist_pages(url: str, start: int = 1, end: int | None = None) -> AsyncIterator[list[str]]:
+    """Yield a playlist's track URLs page by page without blocking the loop."""
+    if SPOTIFY_LIST_RE.search(url):
+        async for page in spotify_pages(url, start, end):
+            yield page
+        return
+    pages: asyncio.Queue[list[str] | BaseException | None] = asyncio.Queue()
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    emit = lambda item: loop.call_soon_threadsafe(pages.put_nowait, item)
+    loop.run_in_executor(None, list_playlist, url, start, end, stop, emit)
+    try:
+        while (page := await pages.get()) is not None:
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        stop.set()
+
+async def expand_playlist(player: MusicPlayer, job: IngestJob, first_page: asyncio.Future,
+                          shuffle: bool, start: int, end: int | None):
+    try:
+        if shuffle:
+            # a fair shuffle needs the whole listing before anything is queued
+            queries = [q async for page in playlist_pages(job.source, start, end) for q in page]
+            random.shuffle(queries)
+            ingest(player, job, queries)
         else:
-            channels = list_voice_channels()
-            if channels:
-                first_id = next(iter(channels.keys()))
-                await join_channel(first_id)
-                vc = player.voice_client
-    global playback_task
-    if vc and (not playback_task or playback_task.done()):
-        playback_task = bot.loop.create_task(playback_loop(None))
-    return songs
-
-player = MusicPlayer()
+            async for page in playlist_pages(job.source, start, end):
+                ingest(player, job, page, last=False)
+                if not first_page.done():
+                    first_page.set_result(None)
+                if job.enqueued:                # queue full
+                    break
+    except Exception as e:
+        log.warning(f"Playlist {job.source} stopped expanding: {e}")
+        if not first_page.done():
+            first_page.set_exception(e)
+    finally:
+        job.enqueued = True
+        player.touch()
+        if not first_page.done():
+            first_page.set_result(None)
+
+def stop_expansions(player: MusicPlayer, origin: str | None = None):
+    """Stop adding pages from playlists (all, or one origin) still being listed."""
+    for job in player.ingest_jobs.values():
+        if origin and job.origin != origin:
+            continue
+        if job.expansion and not job.expansion.done():
+            job.expansion.cancel()
+
+async def add_playlist(player: MusicPlayer, url: str, job: IngestJob | None = None,
+                       shuffle: bool = False, start: int = 1,
+                       end: int | None = None) -> IngestJob:
+    """
+    Queue a playlist's tracks; they download as they near the playhead.
+
+    Returns once the first page is queued while the rest of the listing
+    keeps loading in the background (``job.enqueued`` turns True when it
+    is done). ``start``/``end`` pick a 1-based range; ``shuffle`` randomises
+    the order before anything is queued.
+    """
+    job = job or new_ingest_job(player, url)
+    job.origin = player.last_playlist = f"playlist:{job.id}"
+    first_page = asyncio.get_running_loop().create_future()
+    job.expansion = bot.loop.create_task(
+        expand_playlist(player, job, first_page, shuffle, max(1, start), end))
+    await first_page
+    return job
+
+async def add_playlist_and_play(player: MusicPlayer, url: str, job: IngestJob | None = None,
+                                **options) -> IngestJob:
+    """Add playlist tracks and ensure playback starts."""
+    job = await add_playlist(player, url, job, **options)
+    await connect_default_channel(player)
+    start_playback(player)
+    return job
+
+
+# ---- Track cache ----
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})'
+)
+SPOTIFY_TRACK_RE = re.compile(r'https?://(?:open\.)?spotify\.com/(?:intl-\w+/)?track/(\w+)')
+SPOTIFY_LIST_RE = re.compile(r'https?://(?:open\.)?spotify\.com/(?:intl-\w+/)?(?:album|playlist)/\w+')
+
+def source_key(query: str) -> str | None:
+    """Return the cache key for a YouTube or Spotify track URL, if it has one."""
+    m = YOUTUBE_ID_RE.search(query)
+    if m:
+        return f"youtube:{m.group(1)}"
+    m = SPOTIFY_TRACK_RE.search(query)
+    if m:
+        return f"spotify:{m.group(1)}"
+    return None
+
+class TrackCache:
+    """Downloaded tracks keyed by source ID, evicted LRU-first past a byte budget."""
+    SAVE_DELAY = 5.0      # seconds a cache hit's LRU bump waits to be written
+
+    def __init__(self, index_path: str, max_bytes: int):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.save_handle: asyncio.TimerHandle | None = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = []
+        # stored oldest-first so the OrderedDict keeps LRU order
+        for entry in sorted(data, key=lambda e: e.get('last_used', 0)):
+            if os.path.isfile(entry.get('path', '')):
+                self.entries[entry['key']] = entry
+
+    def save(self):
+        if self.save_handle:
+            self.save_handle.cancel()
+            self.save_handle = None
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(list(self.entries.values()), f)
+        os.replace(tmp, self.index_path)
+
+    def save_later(self):
+        """Write the index SAVE_DELAY from now, once for any number of changes."""
+        if self.save_handle:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self.save_handle = loop.call_later(self.SAVE_DELAY, self.save)
+
+    def peek(self, key: str) -> dict | None:
+        """The entry for ``key`` if its file is there, leaving LRU order alone."""
+        entry = self.entries.get(key)
+        return entry if entry and os.path.isfile(entry['path']) else None
+
+    def get(self, key: str) -> dict | None:
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if not os.path.isfile(entry['path']):
+            del self.entries[key]
+            remove_variants(entry)
+            self.save()
+            return None
+        entry['last_used'] = time.time()
+        self.entries.move_to_end(key)
+        self.save_later()
+        return entry
+
+    def put(self, key: str, path: str, title: str, duration: float,
+            codec: str | None = None, abr: float | None = None) -> dict:
+        old = self.entries.pop(key, None)
+        if old:
+            remove_variants(old)
+        if old and old['path'] != path:
+            try: os.remove(old['path'])
+            except OSError: pass
+        entry = {
+            'key': key,
+            'path': path,
+            'title': title,
+            'duration': duration,
+            'codec': codec,
+            'abr': abr,
+            'size': os.path.getsize(path),
+            'last_used': time.time(),
+        }
+        self.entries[key] = entry
+        self.save()
+        return entry
+
+    def update(self, key: str, **fields):
+        """Add fields to an entry without touching its LRU position."""
+        entry = self.entries.get(key)
+        if entry:
+            entry.update(fields)
+            self.save()
+
+    def paths(self) -> set[str]:
+        return {e['path'] for e in self.entries.values()}
+
+    def total_bytes(self) -> int:
+        return sum(e['size'] for e in self.entries.values())
+
+    def evict(self, pinned: set[str] = frozenset()) -> int:
+        """Drop least recently used files until the cache fits its budget."""
+        total = self.total_bytes()
+        removed = 0
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            entry = self.entries[key]
+            if entry['path'] in pinned:
+                continue
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning(f"Could not evict {entry['path']}: {e}")
+                continue
+            remove_variants(entry)
+            del self.entries[key]
+            total -= entry['size']
+            removed += 1
+        if removed:
+            self.save()
+        return removed
+
+def remove_variants(entry: dict):
+    """Delete a cache entry's pre-encoded Opus files."""
+    for path in (entry.get('variants') or {}).values():
+        try: os.remove(path)
+        except OSError: pass
+
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+os.makedirs(TTS_DIR, exist_ok=True)
+track_cache = TrackCache(CACHE_INDEX, CACHE_MAX_MB * 1024 * 1024)
+
+def in_use_paths() -> set[str]:
+    """Files that must survive eviction: every guild's current song and queue."""
+    paths = set()
+    for player in players.values():
+        paths.update(s.filepath for s in player.queue if s.filepath)
+        if player.current:
+            paths.add(player.current.filepath)
+    return paths
+
+def cache_song(song: Song) -> Song:
+    """Record a freshly downloaded song in the track cache and the library."""
+    if song.key:
+        track_cache.put(song.key, song.filepath, song.title, song.duration,
+                        song.codec, song.abr)
+        track_cache.evict(in_use_paths() | {song.filepath})
+        analyze_later(song.key)
+        archived = os.path.join(RAW_DIR, os.path.basename(song.filepath)) if DEBUG_ARCHIVE else None
+        library.add(song.key, song.title, song.uploader, song.duration, song.filepath, archived)
+        if archived:
+            save_archive_meta(archived, song)
+    return song
 
 # ---- Audio configuration ----
-def channel_bitrate() -> int:
-    """Return the target bitrate in kbps for the connected voice channel."""
+MAX_CHANNEL_KBPS = 384   # highest voice channel bitrate (boosted servers)
+
+def channel_bitrate(player: MusicPlayer) -> int:
+    """Return the target bitrate in kbps for the guild's connected voice channel."""
     vc = player.voice_client
     if vc and vc.channel and getattr(vc.channel, 'bitrate', None):
         try:
             # Discord allows up to 384 kb/s for boosted servers.
             # Convert the channel bitrate from bps to kbps and clamp it.
-            return max(94, min(vc.channel.bitrate // 1000, 384))
+            return max(94, min(vc.channel.bitrate // 1000, MAX_CHANNEL_KBPS))
         except Exception:
             pass
     # Default to a higher quality bitrate when the channel doesn't report one
     return 128
 
-def ffmpeg_options(room_kbps: int) -> list[str]:
-    return [
-        "-vn", "-sn",                   # audio-only
-        #"-af",  "loudnorm=I=-16:TP=-1.5:LRA=7",  # gentle LUFS normalise
-        "-vbr", "constrained",          # CVBR survives Discord re-muxing better
-        #"-application", "audio",        # duplicate-safe but explicit
-    ]
+class RampedVolume(discord.PCMVolumeTransformer):
+    """
+    PCM volume control that glides to a new level over VOLUME_RAMP_MS
+    instead of jumping, so live changes don't click. ``trim`` is a fixed
+    gain on top of the volume (the track's loudness correction).
+    """
+    FRAME = 3840          # bytes in 20 ms of 48 kHz stereo s16le
+    SLICES = 8            # gain steps per frame while ramping
+
+    def __init__(self, original: discord.AudioSource, volume: float = 1.0, trim: float = 1.0):
+        super().__init__(original, volume)
+        self.trim = trim
+        self.gain = min(volume, 2.0)
+        self.target = self.gain
+        self.frames_left = 0
+
+    @property
+    def _current_error(self) -> Exception | None:
+        # discord.py only checks the top-level source for an ffmpeg failure
+        return getattr(self.original, '_current_error', None)
+
+    def read(self) -> bytes:
+        ret = self.original.read()
+        target = min(self.volume, 2.0)
+        if target != self.target:
+            self.target = target
+            self.frames_left = max(1, VOLUME_RAMP_MS // 20)
+        if not self.frames_left or len(ret) != self.FRAME:
+            return audioop.mul(ret, 2, self.gain * self.trim)
+        # linear ramp across this frame in small slices
+        end = self.gain + (self.target - self.gain) / self.frames_left
+        self.frames_left -= 1
+        size = self.FRAME // self.SLICES
+        out = []
+        for i in range(self.SLICES):
+            g = self.gain + (end - self.gain) * (i + 1) / self.SLICES
+            out.append(audioop.mul(ret[i * size:(i + 1) * size], 2, g * self.trim))
+        self.gain = end
+        return b"".join(out)
+
+class UpcomingTrack:
+    """The next track's source, opened ahead of time, and its spoken intro."""
+
+    def __init__(self, song: Song, source: discord.AudioSource,
+                 intro: discord.AudioSource | None = None):
+        self.song = song
+        self.source = source
+        self.intro = intro        # PCM announcement laid over a chained start
+
+    def cleanup(self):
+        self.source.cleanup()
+        if self.intro:
+            self.intro.cleanup()
+
+class TrackChain(discord.AudioSource):
+    """
+    PCM source that plays consecutive tracks back to back. The next track's
+    source is opened ahead of time (see prewarm) and queued here; it takes
+    over in the same read() that finds the current one exhausted, so the
+    voice client never stops between tracks. With CROSSFADE_MS the two are
+    mixed over the outgoing track's last frames. Announcements are laid
+    over the music, which is ducked while they play.
+
+    A stream that fails or stops short of its duration ends the chain with
+    ``_current_error`` set instead of switching, so the playback loop can
+    resume it from the download.
+    """
+    FRAME = RampedVolume.FRAME
+    DUCK = 0.3            # music gain under an announcement
+    EARLY = 100           # frames short of the end that count as a broken stream
+
+    def __init__(self, song: Song, source: discord.AudioSource, position: float,
+                 on_switch: Callable[[UpcomingTrack, float, float], None]):
+        self.song = song
+        self.current = source
+        self._current_error: Exception | None = None
+        self.frames_left = self.frames(song, position)
+        self.upcoming: UpcomingTrack | None = None
+        self.faded = 0        # frames of the upcoming track already mixed in
+        self.overlay: discord.AudioSource | None = None
+        self.lock = threading.Lock()
+        self.on_switch = on_switch    # called on the audio thread after a switch
+        self.last_frame_at: float | None = None   # perf_counter of the last frame out
+
+    @staticmethod
+    def frames(song: Song, position: float) -> int | None:
+        return int((song.duration - position) * 50) if song.duration else None
+
+    def is_opus(self) -> bool:
+        return False
+
+    def enqueue(self, upcoming: UpcomingTrack):
+        with self.lock:
+            self.upcoming = upcoming
+            self.faded = 0
+
+    def withdraw(self, upcoming: UpcomingTrack) -> bool:
+        """Unqueue ``upcoming``; False if it is already playing."""
+        with self.lock:
+            if self.upcoming is upcoming:
+                self.upcoming = None
+            return upcoming.source is not self.current
+
+    def announce(self, source: discord.AudioSource | None):
+        """Lay ``source`` over the music, replacing any announcement in progress."""
+        with self.lock:
+            old, self.overlay = self.overlay, source
+        if old:
+            old.cleanup()
+
+    def broke_off(self) -> Exception | None:
+        """Why the current track ended, if it is a stream that ended too soon."""
+        if not self.song.streaming:
+            return None
+        error = getattr(self.current, '_current_error', None)
+        if error is None and self.frames_left is not None and self.frames_left > self.EARLY:
+            error = RuntimeError(f"stream ended {self.frames_left * 0.02:.1f}s early")
+        return error
+
+    def read(self) -> bytes:
+        data = self.current.read()
+        if self.frames_left is not None:
+            self.frames_left -= 1
+        if not data:
+            self._current_error = self.broke_off()
+            if self._current_error:
+                return b''
+        switched = None
+        with self.lock:
+            fade = CROSSFADE_MS // 20
+            if data and self.upcoming and fade and self.frames_left is not None \
+                    and self.frames_left < fade:
+                incoming = self.upcoming.source.read()
+                if len(incoming) == len(data):
+                    t = min(1.0, max(0.0, 1 - self.frames_left / fade))
+                    data = audioop.add(audioop.mul(data, 2, 1 - t), audioop.mul(incoming, 2, t), 2)
+                    self.faded += 1
+            if not data and self.upcoming:
+                switched = self.upcoming
+                self.current.cleanup()
+                self.current, self.upcoming = switched.source, None
+                self.song = switched.song
+                lead = self.faded * 0.02
+                self.frames_left = self.frames(switched.song, lead)
+                data = self.current.read()
+                # frames come every 20 ms; anything past that is a gap
+                gap = 0.0
+                if self.last_frame_at is not None:
+                    gap = max(0.0, time.perf_counter() - self.last_frame_at - 0.02)
+                if switched.intro:
+                    old, self.overlay = self.overlay, switched.intro
+                    if old:
+                        old.cleanup()
+            overlay = self.overlay
+        if data:
+            self.last_frame_at = time.perf_counter()
+        if switched:
+            self.on_switch(switched, lead, gap)
+        if data and overlay:
+            voice = overlay.read()
+            if len(voice) == len(data):
+                data = audioop.add(audioop.mul(data, 2, self.DUCK), voice, 2)
+            else:
+                with self.lock:
+                    if self.overlay is overlay:
+                        self.overlay = None
+                overlay.cleanup()
+        return data
+
+    def cleanup(self):
+        # a queued track stays open: the playback loop still owns it
+        self.current.cleanup()
+        self.announce(None)
 
 # ---- Voice channel helpers ----
-def list_voice_channels() -> dict[int, str]:
-    if not bot.guilds:
+def list_voice_channels(guild: discord.Guild | None) -> dict[int, str]:
+    if not guild:
         return {}
-    guild = bot.guilds[0]
     return {ch.id: ch.name for ch in guild.voice_channels}
 
-async def join_channel(channel_id: int):
-    channels = list_voice_channels()
-    if channel_id not in channels:
+async def join_channel(player: MusicPlayer, channel_id: int):
+    guild = player.guild
+    if channel_id not in list_voice_channels(guild):
         return
-    guild = bot.guilds[0]
     channel = guild.get_channel(channel_id)
     if not isinstance(channel, discord.VoiceChannel):
         return
@@ -221,167 +1322,1224 @@ async def join_channel(channel_id: int):
         player.voice_client = vc
     else:
         player.voice_client = await channel.connect()
-    global last_channel_id
-    last_channel_id = channel_id
+    player.last_channel_id = channel_id
+    player.dirty()
+
+# ---- TTS helper ----
+# Announcements are rendered once per (text, lang, engine) to an Ogg Opus
+# clip under TTS_DIR and replayed from there without any transcode.
+def gtts_engine(text: str, lang: str, out: str):
+    gTTS(text, lang=lang).save(out)
+
+def espeak_engine(text: str, lang: str, out: str):
+    """Offline synthesis with espeak-ng (or espeak)."""
+    exe = which('espeak-ng') or which('espeak')
+    if not exe:
+        raise RuntimeError("espeak-ng not installed")
+    spawns.inc('espeak')
+    subprocess.run([exe, '-v', lang, '-w', out, text],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+TTS_ENGINES = {
+    'gtts': gtts_engine,
+    'espeak': espeak_engine,
+}
+
+# rendered at startup so the most common prompts never wait on the network
+TTS_PROMPTS = [
+    "Please wait, downloading song",
+    "Please wait, downloading playlist",
+    "Please wait, downloading playlist this may take a while",
+]
+
+tts_pending: dict[str, asyncio.Task] = {}
+
+def tts_path(text: str, lang: str = 'en', engine: str | None = None) -> str:
+    engine = engine or TTS_ENGINE
+    digest = hashlib.sha1(f"{engine}\0{lang}\0{text}".encode()).hexdigest()
+    return os.path.join(TTS_DIR, f"{digest}.opus")
+
+def render_tts(text: str, lang: str, engine: str, path: str):
+    """Synthesize ``text`` and encode it to an Ogg Opus clip at ``path``."""
+    raw = f"{path}.src"
+    try:
+        with tts_seconds.timer(engine):
+            TTS_ENGINES[engine](text, lang, raw)
+            spawns.inc('ffmpeg')
+            subprocess.run(
+                ["ffmpeg", "-y", "-i", raw, "-c:a", "libopus", "-b:a", "64k",
+                 "-ar", "48000", "-ac", "2", "-f", "ogg", f"{path}.tmp"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+            )
+        os.replace(f"{path}.tmp", path)
+    finally:
+        for leftover in (raw, f"{path}.tmp"):
+            try: os.remove(leftover)
+            except OSError: pass
+
+def evict_tts():
+    """Keep at most TTS_CACHE_CLIPS clips, dropping the least recently used."""
+    prompts = {tts_path(t) for t in TTS_PROMPTS}
+    clips = [os.path.join(TTS_DIR, f) for f in os.listdir(TTS_DIR) if f.endswith('.opus')]
+    clips = [p for p in clips if p not in prompts]
+    excess = len(clips) + len(prompts) - TTS_CACHE_CLIPS
+    if excess <= 0:
+        return
+    clips.sort(key=os.path.getmtime)
+    for path in clips[:excess]:
+        try: os.remove(path)
+        except OSError: pass
+
+async def tts_clip(text: str, lang: str = 'en') -> str | None:
+    """Return the cached clip for ``text``, rendering it first if needed."""
+    path = tts_path(text, lang)
+    if os.path.isfile(path):
+        os.utime(path)                  # mtime doubles as LRU timestamp
+        cache_requests.inc('tts', 'hit')
+        return path
+    cache_requests.inc('tts', 'miss')
+    task = tts_pending.get(path)
+    if not task:
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(None, render_tts, text, lang, TTS_ENGINE, path)
+        tts_pending[path] = task
+    try:
+        await task
+    except Exception as e:
+        log.warning(f"TTS failed for {text!r}: {e}")
+        return None
+    finally:
+        tts_pending.pop(path, None)
+    evict_tts()
+    return path
 
-# ---- TTS helper (gTTS) ----
-async def speak(text: str):
+async def prerender_prompts():
+    for text in TTS_PROMPTS:
+        await tts_clip(text)
+
+async def speak(player: MusicPlayer, text: str):
     vc = player.voice_client
     if not vc:
         return
-    while vc.is_playing():
-        await asyncio.sleep(0.1)
-    tts_mp3 = os.path.join(DOWNLOAD_DIR, f"tts_{uuid.uuid4()}.mp3")
-    loop = asyncio.get_event_loop()
-    def gen_tts():
-        t = gTTS(text, lang='en')
-        t.save(tts_mp3)
-    try:
-        await loop.run_in_executor(None, gen_tts)
-    except Exception:
+    clip = await tts_clip(text)
+    if not clip:
         return
-    done = asyncio.Event()
-    bit = channel_bitrate()
-    opts = ffmpeg_options(channel_bitrate())
-    log.debug("FFMPEG OPTS  %s", " ".join(opts))   #  add this
-    reconnect = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
-
-    src = await discord.FFmpegOpusAudio.from_probe(
-        tts_mp3,                        # or song.filepath
-        options="-vn -sn"      # nothing that would force re-encode
-    )
-    vc.play(src, after=lambda _: done.set())
-    await done.wait()
+    chain = player.chain
+    if chain and vc.source is chain and not player.idle.is_set():
+        # a chain plays until the queue runs dry; talk over it instead
+        spawns.inc('ffmpeg')
+        chain.announce(discord.FFmpegPCMAudio(clip))
+        return
+    await wait_idle(player)
+    spawns.inc('ffmpeg')
+    start_audio(player, discord.FFmpegOpusAudio(clip, codec='copy'))
+    await wait_idle(player)
+
+async def wait_idle(player: MusicPlayer):
+    """Wait until the voice client has finished what it is playing."""
+    while not player.idle.is_set():
+        await player.idle.wait()
+
+def start_audio(player: MusicPlayer, source: discord.AudioSource,
+                after: Callable[[Exception | None], None] | None = None, **options):
+    """``vc.play`` that keeps ``player.idle`` up to date."""
+    def finished(error: Exception | None):
+        bot.loop.call_soon_threadsafe(player.idle.set)
+        if after:
+            after(error)
+    player.voice_client.play(source, after=finished, **options)
+    player.idle.clear()
+
+# ---- Archive ----
+class ArchiveJob:
+    """Snapshot one downloaded track into the _archive/ tree."""
+
+    def __init__(self, path: str, opus: bool):
+        self.id = uuid.uuid4().hex[:8]
+        self.path = path
+        self.opus = opus
+        self.status = 'queued'      # queued -> running -> done | failed
+        self.error: str | None = None
+        self.created = time.time()
+
+    def summary(self) -> dict:
+        return {
+            'id': self.id,
+            'file': os.path.basename(self.path),
+            'status': self.status,
+            'error': self.error,
+        }
+
+archive_queue: asyncio.Queue[ArchiveJob] = asyncio.Queue()
+archive_jobs: OrderedDict[str, ArchiveJob] = OrderedDict()
+ARCHIVE_JOBS_KEPT = 50
+
+def archive(path: str, opus: bool) -> ArchiveJob:
+    """Queue an archive snapshot of ``path``; never waits for it."""
+    job = ArchiveJob(path, opus)
+    archive_jobs[job.id] = job
+    while len(archive_jobs) > ARCHIVE_JOBS_KEPT:
+        archive_jobs.popitem(last=False)
+    archive_queue.put_nowait(job)
+    return job
+
+async def link_raw(src: str, dst: str):
+    """
+    Put ``src`` at ``dst`` without copying bytes where possible: a hardlink,
+    else a reflink (cp falls back to a plain copy on filesystems without them).
+    """
     try:
-        os.remove(tts_mp3)
-    except:
+        os.link(src, dst)
+        return
+    except OSError:
         pass
-
-# ---- Download logic ----
-def get_audio_duration(path: str) -> float:
-    """Return audio duration in seconds using ffprobe."""
+    spawns.inc('cp')
+    proc = await asyncio.create_subprocess_exec(
+        'cp', '--reflink=auto', '--preserve=timestamps', src, dst,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    if await proc.wait() != 0:
+        raise RuntimeError("copy to archive failed")
+
+async def run_archive(job: ArchiveJob):
+    # 1) raw copy (identical bytes)
+    raw_copy = os.path.join(RAW_DIR, os.path.basename(job.path))
+    if not os.path.isfile(raw_copy):
+        await link_raw(job.path, raw_copy)
+
+    # 2) single-pass Opus encode at 128k, from the raw copy so cache
+    # eviction of the working file can't race us
+    basename = os.path.splitext(os.path.basename(job.path))[0]
+    enc_copy = os.path.join(ENC_DIR, f"{basename}.opus")
+    if os.path.isfile(enc_copy):
+        return
+    # if the source **is already** Opus we only remux it into Ogg
+    if job.opus:
+        codec = ["-c:a", "copy"]
+    else:
+        codec = ["-c:a", "libopus", "-b:a", "128k"]
+    tmp = enc_copy + '.part'
+    spawns.inc('ffmpeg')
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-y', '-i', raw_copy, *codec, '-vn', '-sn', '-f', 'ogg', tmp,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    if await proc.wait() != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError("ffmpeg archive encode failed")
+    os.replace(tmp, enc_copy)
+
+async def archive_worker():
+    while True:
+        job = await archive_queue.get()
+        job.status = 'running'
+        try:
+            await run_archive(job)
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            log.warning(f"Archive of {job.path} failed: {e}")
+        finally:
+            archive_queue.task_done()
+
+def start_archive_workers():
+    for _ in range(ARCHIVE_WORKERS):
+        bot.loop.create_task(archive_worker())
+
+# ---- Media probe ----
+class ProbeIndex:
+    """ffprobe results keyed by path, valid while the file's size and mtime match."""
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.entries: dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self.entries = {p: e for p, e in data.items() if os.path.isfile(p)}
+
+    def save(self):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.index_path)
+
+    def get(self, path: str, st: os.stat_result) -> dict | None:
+        entry = self.entries.get(path)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry
+        return None
+
+    def put(self, path: str, st: os.stat_result, info: dict) -> dict:
+        # drop entries whose files are gone so the index stays small
+        self.entries = {p: e for p, e in self.entries.items() if os.path.isfile(p)}
+        self.entries[path] = {**info, 'size': st.st_size, 'mtime': st.st_mtime}
+        self.save()
+        return self.entries[path]
+
+probe_index = ProbeIndex(PROBE_INDEX)
+probe_pending: dict[str, asyncio.Task] = {}
+EMPTY_PROBE = {'title': None, 'artist': None, 'duration': 0.0, 'codec': None, 'abr': None,
+               'sample_rate': None}
+
+async def run_ffprobe(path: str) -> dict:
+    spawns.inc('ffprobe')
+    proc = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries',
+        'format=duration,bit_rate:format_tags=title,artist:stream=codec_name,sample_rate,bit_rate',
+        '-of', 'json', path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("ffprobe failed")
+    data = json.loads(out)
+    fmt = data.get('format', {})
+    stream = (data.get('streams') or [{}])[0]
+    bit_rate = stream.get('bit_rate') or fmt.get('bit_rate')
+    tags = {k.lower(): v for k, v in (fmt.get('tags') or {}).items()}
+    return {
+        'title': tags.get('title'),
+        'artist': tags.get('artist'),
+        'duration': float(fmt.get('duration') or 0),
+        'codec': stream.get('codec_name'),
+        'abr': int(bit_rate) / 1000 if bit_rate else None,
+        'sample_rate': int(stream['sample_rate']) if stream.get('sample_rate') else None,
+    }
+
+async def probe(path: str) -> dict:
+    """
+    Duration, codec, bitrate (kbps) and sample rate of a local file. Each
+    file is probed once; later calls are answered from the on-disk index.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return EMPTY_PROBE
+    entry = probe_index.get(path, st)
+    cache_requests.inc('probe', 'hit' if entry else 'miss')
+    if entry:
+        return entry
+    task = probe_pending.get(path)
+    if not task:
+        task = asyncio.ensure_future(run_ffprobe(path))
+        probe_pending[path] = task
+        task.add_done_callback(lambda t: probe_pending.pop(path, None))
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1', path],
-            capture_output=True, text=True, check=True
-        )
-        return float(result.stdout.strip())
-    except Exception:
+        # shared by every caller: one of them being cancelled mustn't stop it
+        info = await asyncio.shield(task)
+    except Exception as e:
+        log.warning(f"Probe failed for {path}: {e}")
+        return EMPTY_PROBE
+    return probe_index.get(path, st) or probe_index.put(path, st, info)
+
+# ---- Loudness analysis ----
+# Every cached track is measured once, in the background, for integrated
+# loudness and true peak (EBU R128, ffmpeg's loudnorm in analysis mode).
+# The results live in its track cache entry; playback turns them into a
+# static gain in the PCM path instead of running a normalization filter.
+LOUDNESS_MAX_GAIN_DB = 12.0   # don't blow up near-silent tracks
+LOUDNESS_CEILING = -1.0       # dBTP the gain may raise peaks to
+
+loudness_queue: asyncio.Queue[str] = asyncio.Queue()
+loudness_queued: set[str] = set()
+
+def analyze_later(key: str):
+    """Queue a cached track for loudness analysis unless it already has it."""
+    entry = track_cache.entries.get(key)
+    if not NORMALIZE:
+        encode_later(key)
+    elif entry and 'loudness' not in entry and key not in loudness_queued:
+        loudness_queued.add(key)
+        loudness_queue.put_nowait(key)
+
+async def measure_loudness(path: str) -> tuple[float, float]:
+    """Integrated loudness (LUFS) and true peak (dBTP) of a file."""
+    spawns.inc('ffmpeg')
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-nostats', '-threads', '1', '-i', path, '-map', '0:a:0',
+        '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError("ffmpeg loudness analysis failed")
+    text = err.decode(errors='replace')
+    stats = json.loads(text[text.rindex('{'):text.rindex('}') + 1])
+    return float(stats['input_i']), float(stats['input_tp'])
+
+async def loudness_worker():
+    while True:
+        key = await loudness_queue.get()
+        loudness_queued.discard(key)
+        entry = track_cache.entries.get(key)
+        if not entry or 'loudness' in entry:
+            continue
+        path = entry['path']
+        try:
+            with loudness_seconds.timer():
+                loudness, peak = await measure_loudness(path)
+        except Exception as e:
+            log.warning(f"Loudness analysis of {path} failed: {e}")
+            loudness = peak = None      # recorded so it isn't retried
+        entry = track_cache.entries.get(key)
+        if entry and entry['path'] == path:
+            track_cache.update(key, loudness=loudness, peak=peak)
+            encode_later(key)
+
+def start_loudness_workers():
+    for key in list(track_cache.entries):
+        analyze_later(key)
+    for _ in range(LOUDNESS_WORKERS):
+        bot.loop.create_task(loudness_worker())
+
+def track_gain_db(song: Song) -> float:
+    """Gain that brings ``song`` to LOUDNESS_TARGET; 0 until it is analyzed."""
+    return entry_gain_db(track_cache.entries.get(song.key) if song.key else None)
+
+def entry_gain_db(entry: dict | None) -> float:
+    if not NORMALIZE or not entry or entry.get('loudness') is None:
         return 0.0
+    gain = LOUDNESS_TARGET - entry['loudness']
+    if entry.get('peak') is not None:
+        gain = min(gain, LOUDNESS_CEILING - entry['peak'])
+    return max(-LOUDNESS_MAX_GAIN_DB, min(gain, LOUDNESS_MAX_GAIN_DB))
+
+# ---- Opus bitrate ladder ----
+# Cached tracks are encoded once more, in the background and after their
+# loudness analysis, to Ogg Opus at each OPUS_LADDER bitrate with the
+# loudness gain baked in. Playback sends the variant that fits the voice
+# channel as-is, so a cached track at full volume costs no live encode.
+ladder_queue: asyncio.Queue[str] = asyncio.Queue()
+ladder_queued: set[str] = set()
+ladder_parts: set[str] = set()        # .part files of the encode running now
+
+def encode_later(key: str):
+    entry = track_cache.entries.get(key)
+    if OPUS_LADDER and entry and 'variants' not in entry and key not in ladder_queued:
+        ladder_queued.add(key)
+        ladder_queue.put_nowait(key)
+
+async def encode_ladder(entry: dict, gain: float) -> dict[str, str]:
+    """Encode every ladder bitrate of a cached track in one ffmpeg run."""
+    os.makedirs(LADDER_DIR, exist_ok=True)
+    base = os.path.join(LADDER_DIR, re.sub(r'[^\w.-]', '_', entry['key']))
+    variants = {str(kbps): f"{base}.{kbps}.opus" for kbps in OPUS_LADDER}
+    args = ['ffmpeg', '-y', '-hide_banner', '-nostats', '-i', entry['path']]
+    for kbps, path in variants.items():
+        args += ['-map', '0:a:0', '-af', f'volume={gain:.2f}dB', '-c:a', 'libopus',
+                 '-b:a', f'{kbps}k', '-vbr', 'on', '-ar', '48000', '-ac', '2',
+                 '-f', 'ogg', f"{path}.part"]
+    parts = {f"{path}.part" for path in variants.values()}
+    ladder_parts.update(parts)
+    try:
+        spawns.inc('ffmpeg')
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            ok = await proc.wait() == 0
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+    finally:
+        ladder_parts.difference_update(parts)
+    for path in variants.values():
+        if ok:
+            os.replace(f"{path}.part", path)
+        else:
+            try: os.remove(f"{path}.part")
+            except OSError: pass
+    if not ok:
+        raise RuntimeError("ffmpeg ladder encode failed")
+    return variants
+
+async def ladder_worker():
+    while True:
+        key = await ladder_queue.get()
+        ladder_queued.discard(key)
+        entry = track_cache.entries.get(key)
+        if not entry or 'variants' in entry:
+            continue
+        path, gain = entry['path'], entry_gain_db(entry)
+        try:
+            with ladder_seconds.timer():
+                variants = await encode_ladder(entry, gain)
+        except Exception as e:
+            log.warning(f"Opus ladder encode of {path} failed: {e}")
+            variants = {}               # recorded so it isn't retried
+        entry = track_cache.entries.get(key)
+        if entry and entry['path'] == path:
+            size = entry['size'] + sum(os.path.getsize(p) for p in variants.values())
+            track_cache.update(key, variants=variants, ladder_gain=gain, size=size)
+        else:
+            remove_variants({'variants': variants})
 
-async def download_audio(query: str) -> Song:
+def sweep_ladder_parts() -> int:
+    """Delete .part files left in LADDER_DIR by encodes that never finished."""
+    try:
+        names = os.listdir(LADDER_DIR)
+    except OSError:
+        return 0
+    removed = 0
+    for name in names:
+        path = os.path.join(LADDER_DIR, name)
+        if name.endswith('.part') and path not in ladder_parts:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def start_ladder_workers():
+    sweep_ladder_parts()
+    for key, entry in list(track_cache.entries.items()):
+        if not NORMALIZE or 'loudness' in entry:
+            encode_later(key)
+    bot.loop.create_task(ladder_worker())
+
+def ladder_variant(player: MusicPlayer, song: Song) -> tuple[str, int] | None:
+    """
+    The pre-encoded variant of ``song`` for the player's channel: the
+    highest bitrate the channel carries (or the lowest one there is). None
+    when there isn't one or it doesn't fit the current volume and gain.
     """
-    Download a track (YouTube or Spotify), optionally copy the *raw*
-    file and a *single-pass* Opus encode into the _archive/ tree, and
-    return the Song pointing at the working copy inside DOWNLOAD_DIR.
+    entry = track_cache.entries.get(song.key) if song.key else None
+    variants = entry.get('variants') if entry else None
+    if not variants or player.volume != 1.0:
+        return None
+    if abs(entry.get('ladder_gain', 0.0) - entry_gain_db(entry)) >= 0.5:
+        return None                     # the target changed since it was encoded
+    room = channel_bitrate(player)
+    rates = sorted(int(k) for k in variants)
+    kbps = max((r for r in rates if r <= room), default=rates[0])
+    path = variants[str(kbps)]
+    return (path, kbps) if os.path.isfile(path) else None
+
+# ---- Local library ----
+class Library:
+    """
+    Every track the bot has downloaded, in SQLite with an FTS5 index over
+    titles, uploaders and source keys. A row points at the working copy
+    and at the raw archive copy, which outlives cache eviction.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            uploader TEXT,
+            duration REAL,
+            path TEXT,
+            archive TEXT,
+            added REAL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+            title, uploader, key, content='tracks', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+            INSERT INTO tracks_fts(rowid, title, uploader, key)
+            VALUES (new.id, new.title, new.uploader, new.key);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+            INSERT INTO tracks_fts(tracks_fts, rowid, title, uploader, key)
+            VALUES ('delete', old.id, old.title, old.uploader, old.key);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+            INSERT INTO tracks_fts(tracks_fts, rowid, title, uploader, key)
+            VALUES ('delete', old.id, old.title, old.uploader, old.key);
+            INSERT INTO tracks_fts(rowid, title, uploader, key)
+            VALUES (new.id, new.title, new.uploader, new.key);
+        END;
+    """
+
+    def __init__(self, db_path: str):
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.SCHEMA)
+
+    def add(self, key: str, title: str, uploader: str | None, duration: float,
+            path: str | None, archive: str | None = None):
+        with self.db:
+            self.db.execute(
+                """INSERT INTO tracks (key, title, uploader, duration, path, archive, added)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                       title = excluded.title,
+                       uploader = coalesce(excluded.uploader, uploader),
+                       duration = excluded.duration,
+                       path = coalesce(excluded.path, path),
+                       archive = coalesce(excluded.archive, archive)""",
+                (key, title, uploader, duration, path, archive, time.time()))
+
+    def get(self, key: str) -> dict | None:
+        row = self.db.execute("SELECT * FROM tracks WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def search(self, text: str, limit: int = LIBRARY_RESULTS, prefix: bool = True,
+               keys: bool = True) -> list[dict]:
+        """
+        Tracks matching every word of ``text``, best first. With ``keys``
+        off only titles and uploaders are searched, not source keys.
+        """
+        words = re.findall(r'\w+', text)
+        if not words:
+            return []
+        star = '*' if prefix else ''
+        match = " ".join(f'"{w}"{star}' for w in words)
+        if not keys:
+            match = f"{{title uploader}} : ({match})"
+        rows = self.db.execute(
+            """SELECT tracks.* FROM tracks_fts JOIN tracks ON tracks.id = tracks_fts.rowid
+               WHERE tracks_fts MATCH ?
+               ORDER BY bm25(tracks_fts, 10.0, 5.0, 1.0) LIMIT ?""",
+            (match, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    def known_paths(self) -> set[str]:
+        rows = self.db.execute("SELECT path, archive FROM tracks").fetchall()
+        return {p for r in rows for p in r if p}
+
+    def prune(self) -> int:
+        """Drop tracks with no copy left on disk."""
+        gone = [r['id'] for r in self.db.execute("SELECT id, path, archive FROM tracks")
+                if not local_copy(r)]
+        with self.db:
+            self.db.executemany("DELETE FROM tracks WHERE id = ?", [(i,) for i in gone])
+        return len(gone)
+
+def local_copy(row) -> str | None:
+    """The library row's working copy, else its archive copy, if on disk."""
+    for path in (row['path'], row['archive']):
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+def library_song(query: str, key: str | None) -> Song | None:
+    """A song for ``query`` played from a local copy, or None."""
+    if key:
+        row = library.get(key)
+    elif LIBRARY_FIRST:
+        # a word like "youtube" would match every source key
+        row = next((r for r in library.search(query, 5, prefix=False, keys=False)
+                    if local_copy(r)), None)
+    else:
+        row = None
+    path = local_copy(row) if row else None
+    cache_requests.inc('library', 'hit' if path else 'miss')
+    return Song.from_library(row, path, query) if path else None
+
+ARCHIVE_AUDIO = ('.opus', '.webm', '.m4a', '.mp3', '.ogg', '.flac', '.wav', '.aac')
+
+def archive_key(name: str) -> str:
+    """Source key for an archived file, from the name it was downloaded under."""
+    stem = os.path.splitext(name)[0]
+    if stem.startswith('spotify_'):
+        return f"spotify:{stem[len('spotify_'):]}"
+    if re.fullmatch(r'[\w-]{11}', stem):
+        return f"youtube:{stem}"
+    return f"file:{stem}"
+
+def archive_meta_path(path: str) -> str:
+    return os.path.join(META_DIR, os.path.splitext(os.path.basename(path))[0] + '.json')
+
+def save_archive_meta(path: str, song: Song):
+    """Keep the song's title and uploader next to its archive copy for rebuilds."""
+    try:
+        with open(archive_meta_path(path), 'w') as f:
+            json.dump({'key': song.key, 'title': song.title, 'uploader': song.uploader,
+                       'duration': song.duration}, f)
+    except OSError as e:
+        log.warning(f"Could not save archive metadata for {song.title}: {e}")
+
+def load_archive_meta(path: str) -> dict | None:
+    try:
+        with open(archive_meta_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+async def rebuild_library():
+    """
+    Index archived files the library doesn't know yet (titles from the
+    metadata saved with the archive copy, else the track cache, else the
+    file's tags) and drop rows whose files are gone. Raw copies are
+    preferred; an encoded copy stands in for a missing raw one.
+    """
+    if not DEBUG_ARCHIVE:
+        library.prune()
+        return
+    known = library.known_paths()
+    raw = {os.path.splitext(n)[0] for n in os.listdir(RAW_DIR)}
+    files = [os.path.join(RAW_DIR, n) for n in os.listdir(RAW_DIR)]
+    files += [os.path.join(ENC_DIR, n) for n in os.listdir(ENC_DIR)
+              if os.path.splitext(n)[0] not in raw]
+    added = 0
+    for path in files:
+        if path in known or not path.lower().endswith(ARCHIVE_AUDIO):
+            continue
+        key = archive_key(os.path.basename(path))
+        entry = track_cache.entries.get(key)
+        meta = load_archive_meta(path)
+        if meta and meta.get('title'):
+            key = meta.get('key') or key
+            title, uploader, duration = meta['title'], meta.get('uploader'), meta.get('duration')
+        elif entry:
+            title, uploader, duration = entry['title'], None, entry['duration']
+        else:
+            meta = await probe(path)
+            title = meta.get('title') or os.path.splitext(os.path.basename(path))[0]
+            uploader, duration = meta.get('artist'), meta['duration']
+        library.add(key, title, uploader, duration, None, path)
+        added += 1
+    pruned = library.prune()
+    log.info(f"Library: {added} archived tracks indexed, {pruned} missing dropped")
+
+def library_entry(row: dict) -> dict:
+    return {
+        'key': row['key'],
+        'title': row['title'],
+        'uploader': row['uploader'],
+        'duration': row['duration'],
+        'local': local_copy(row) is not None,
+    }
+
+library = Library(LIBRARY_DB)
+
+# ---- Spotify ----
+# Albums and playlists are listed with one `spotdl save` metadata pass.
+# Tracks download through SpotifyBatcher, several per spotDL process, and
+# each lands at spotify_path(id): the output template names it after the
+# track ID and the format is fixed, so nothing has to be searched for.
+SPOTIFY_LISTED_KEPT = 5000
+spotify_listed: OrderedDict[str, dict] = OrderedDict()   # track id -> listing title/duration
+
+def spotify_path(track_id: str) -> str:
+    return os.path.join(DOWNLOAD_DIR, f"spotify_{track_id}.{SPOTIFY_FORMAT}")
+
+async def list_spotify(url: str) -> list[str]:
+    """Track URLs of a Spotify album or playlist, from one spotDL metadata pass."""
+    save = os.path.join(DOWNLOAD_DIR, f"{uuid.uuid4().hex}.spotdl")
+    spawns.inc('spotdl')
+    proc = await asyncio.create_subprocess_exec(
+        'spotdl', 'save', url, '--save-file', save,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=SPOTIFY_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill(); await proc.wait()
+            raise RuntimeError("Spotify listing timed out")
+        with open(save) as f:
+            tracks = json.load(f)
+    except (OSError, ValueError):
+        raise RuntimeError("spotDL listed no tracks")
+    finally:
+        try: os.remove(save)
+        except OSError: pass
+    urls = []
+    for t in tracks:
+        m = SPOTIFY_TRACK_RE.search(t.get('url') or '')
+        track_id = m.group(1) if m else t.get('song_id')
+        if not track_id:
+            continue
+        artist = t.get('artist') or ", ".join(t.get('artists') or [])
+        spotify_listed[track_id] = {
+            'title': f"{artist} - {t['name']}" if artist and t.get('name') else t.get('name'),
+            'duration': t.get('duration'),
+        }
+        spotify_listed.move_to_end(track_id)
+        urls.append(f"https://open.spotify.com/track/{track_id}")
+    while len(spotify_listed) > SPOTIFY_LISTED_KEPT:
+        spotify_listed.popitem(last=False)
+    return urls
+
+async def spotify_pages(url: str, start: int = 1, end: int | None = None) -> AsyncIterator[list[str]]:
+    """A Spotify album or playlist in playlist_pages() form."""
+    urls = (await list_spotify(url))[start - 1:end]
+    for i in range(0, len(urls), PLAYLIST_PAGE):
+        yield urls[i:i + PLAYLIST_PAGE]
+
+class SpotifyBatcher:
+    """
+    Download Spotify tracks in shared spotDL runs. Requests that arrive
+    within BATCH_WINDOW of each other, or while every slot is busy, go into
+    one run of up to SPOTIFY_BATCH tracks; at most SPOTIFY_CONCURRENCY runs
+    at once. A track marked urgent (the head of a queue) gets a run of its
+    own so it isn't held up by the rest.
+
+    Each run writes into its own directory under SPOTIFY_DIR and its files
+    are moved to spotify_path() only when spotDL exits by itself; a run
+    that is killed may have left a track half-written, so its files are
+    thrown away and its tracks fail.
+    """
+    BATCH_WINDOW = 0.2
+
+    def __init__(self):
+        self.pending: dict[str, asyncio.Future] = {}    # track id -> path, waiting or running
+        self.waiting: list[str] = []
+        self.slots = asyncio.Semaphore(SPOTIFY_CONCURRENCY)
+        self.dispatching = False
+        self.urgent: set[str] = set()
+
+    async def fetch(self, track_id: str) -> str:
+        future = self.pending.get(track_id)
+        if future is None:
+            future = self.pending[track_id] = asyncio.get_running_loop().create_future()
+            self.waiting.append(track_id)
+            if not self.dispatching:
+                self.dispatching = True
+                asyncio.create_task(self.dispatch())
+        return await asyncio.shield(future)
+
+    async def dispatch(self):
+        try:
+            await asyncio.sleep(self.BATCH_WINDOW)
+            while self.waiting:
+                await self.slots.acquire()
+                size = 1 if self.waiting[0] in self.urgent else SPOTIFY_BATCH
+                batch, self.waiting = self.waiting[:size], self.waiting[size:]
+                self.urgent.difference_update(batch)
+                asyncio.create_task(self.run(batch))
+        finally:
+            self.dispatching = False
+
+    async def run(self, batch: list[str]):
+        error = None
+        staging = os.path.join(SPOTIFY_DIR, uuid.uuid4().hex)
+        try:
+            os.makedirs(staging)
+            spawns.inc('spotdl')
+            proc = await asyncio.create_subprocess_exec(
+                'spotdl', 'download', *(f"https://open.spotify.com/track/{i}" for i in batch),
+                '--format', SPOTIFY_FORMAT,
+                '--output', os.path.join(staging, 'spotify_{track-id}.{output-ext}'),
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=SPOTIFY_TIMEOUT * len(batch))
+            except asyncio.TimeoutError:
+                proc.kill(); await proc.wait()
+                error = "Spotify download timed out"
+            for track_id in batch:
+                staged = os.path.join(staging, os.path.basename(spotify_path(track_id)))
+                if not error and os.path.isfile(staged):
+                    os.replace(staged, spotify_path(track_id))
+        except Exception as e:
+            error = error or str(e)
+        finally:
+            self.slots.release()
+            shutil.rmtree(staging, ignore_errors=True)
+        for track_id in batch:
+            self.urgent.discard(track_id)
+            future = self.pending.pop(track_id)
+            path = spotify_path(track_id)
+            if not error and os.path.isfile(path):
+                future.set_result(path)
+            else:
+                future.set_exception(RuntimeError(error or "spotDL finished but produced no file"))
+
+spotify_batcher = SpotifyBatcher()
+
+# ---- yt-dlp worker pool ----
+# Downloads run in long-lived ytdl_worker.py processes that have yt-dlp
+# loaded already; jobs and results travel as JSON lines over stdin/stdout.
+YTDL_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytdl_worker.py')
+
+class YtdlWorker:
+    def __init__(self, proc: asyncio.subprocess.Process):
+        self.proc = proc
+        self.killed = False
+
+    @classmethod
+    async def spawn(cls) -> 'YtdlWorker':
+        spawns.inc('yt-dlp-worker')
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, YTDL_WORKER,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        worker = cls(proc)
+        msg = await worker.receive()
+        if msg.get('type') != 'ready':
+            worker.kill()
+            raise RuntimeError("yt-dlp worker failed to start")
+        return worker
+
+    @property
+    def alive(self) -> bool:
+        return not self.killed and self.proc.returncode is None
+
+    async def send(self, msg: dict):
+        self.proc.stdin.write(json.dumps(msg).encode() + b"\n")
+        await self.proc.stdin.drain()
+
+    async def receive(self) -> dict:
+        line = await self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("yt-dlp worker exited")
+        return json.loads(line)
+
+    def kill(self):
+        if self.alive:
+            self.killed = True
+            self.proc.kill()
+
+class YtdlPool:
+    """
+    YTDL_WORKERS warm yt-dlp processes. A job that times out or is
+    cancelled takes its worker down with it; a fresh one replaces it.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.idle: asyncio.Queue[YtdlWorker | None] | None = None
+        self.started = False
+
+    def queue(self) -> asyncio.Queue[YtdlWorker | None]:
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for _ in range(self.size):
+                self.idle.put_nowait(None)      # placeholder: spawned on first use
+        return self.idle
+
+    async def start(self):
+        """Spawn the workers ahead of the first job; later calls do nothing."""
+        if self.started:
+            return
+        self.started = True
+        workers = []
+        try:
+            for _ in range(self.size):
+                workers.append(await self.acquire())
+        except Exception as e:
+            log.warning(f"Could not start yt-dlp workers: {e}")
+        finally:
+            for worker in workers:
+                await self.release(worker)
+
+    async def acquire(self) -> YtdlWorker:
+        worker = await self.queue().get()
+        if worker is None or not worker.alive:
+            try:
+                worker = await YtdlWorker.spawn()
+            except Exception:
+                self.idle.put_nowait(None)
+                raise
+        return worker
+
+    async def release(self, worker: YtdlWorker):
+        self.idle.put_nowait(worker if worker.alive else None)
+
+    async def download(self, url: str, fmt: str, outtmpl: str,
+                       on_progress: Callable[[float], None] | None = None) -> dict:
+        """
+        Download ``url`` in a worker and return its info. Fails when the
+        worker is silent for YTDL_STALL_TIMEOUT or the job runs past
+        YTDL_TIMEOUT seconds.
+        """
+        worker = await self.acquire()
+        job_id = uuid.uuid4().hex[:8]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + YTDL_TIMEOUT
+        answered = False
+        try:
+            await worker.send({'id': job_id, 'url': url, 'format': fmt, 'outtmpl': outtmpl})
+            while True:
+                wait = min(YTDL_STALL_TIMEOUT, deadline - loop.time())
+                try:
+                    msg = await asyncio.wait_for(worker.receive(), max(wait, 0))
+                except asyncio.TimeoutError:
+                    raise RuntimeError("YouTube download timed out")
+                if msg.get('id') != job_id:
+                    continue
+                if msg['type'] == 'progress':
+                    if on_progress and msg.get('total'):
+                        on_progress(min(1.0, msg['downloaded'] / msg['total']))
+                    continue
+                answered = True
+                if msg['type'] == 'done':
+                    return msg['info']
+                raise RuntimeError(msg.get('error') or "yt-dlp failed")
+        finally:
+            if not answered:
+                worker.kill()               # timed out or cancelled mid-job
+            await self.release(worker)
+
+ytdl_pool = YtdlPool(YTDL_WORKERS)
+
+# ---- Download logic ----
+
+class QueryCache:
+    """Free-text searches mapped to the video they resolved to, with a TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def get(self, query: str) -> dict | None:
+        norm = self.normalize(query)
+        entry = self.entries.get(norm)
+        if entry and time.time() - entry['resolved_at'] > self.ttl:
+            del self.entries[norm]
+            entry = None
+        if not entry:
+            self.misses += 1
+            cache_requests.inc('query', 'miss')
+            return None
+        self.entries.move_to_end(norm)
+        self.hits += 1
+        cache_requests.inc('query', 'hit')
+        return entry
+
+    def put(self, query: str, song: Song):
+        if not song.key or not song.key.startswith('youtube:'):
+            return
+        self.entries[self.normalize(query)] = {
+            'url': f"https://www.youtube.com/watch?v={song.key.split(':', 1)[1]}",
+            'key': song.key,
+            'title': song.title,
+            'duration': song.duration,
+            'resolved_at': time.time(),
+        }
+        self.entries.move_to_end(self.normalize(query))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def is_search(query: str) -> bool:
+    return not re.match(r'\s*https?://', query)
+
+async def download_audio(query: str, downloads: dict[str, datetime] | None = None) -> Song:
+    """
+    Return a playable Song for a query (YouTube or Spotify).
+
+    Cached tracks are returned straight away, and a search typed recently
+    goes straight to the video it found last time. In STREAM_MODE a
+    YouTube track is only resolved here: the Song carries the direct media
+    URL and the file is fetched in the background for later plays.
+    Running downloads are listed in ``downloads`` (the requesting guild's).
     """
-    import shutil                                    # new
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-    downloads_in_progress[query] = datetime.now()
+
+    target = query
+    search = is_search(query)
+    if search:
+        hit = query_cache.get(query)
+        if hit:
+            target = hit['url']
+            search = False
+
+    key = source_key(target)
+    entry = track_cache.get(key) if key else None
+    if key:
+        cache_requests.inc('track', 'hit' if entry else 'miss')
+    if entry:
+        log.debug("Track cache hit for %s", key)
+        return Song.from_cache(entry, query)
+    song = library_song(query, key) if key or search else None
+    if song:
+        log.debug("Library hit for %s", query)
+        return song
+
+    song = None
+    if STREAM_MODE and not SPOTIFY_TRACK_RE.search(target):
+        try:
+            song = await resolve_stream(target, downloads)
+        except Exception as e:
+            log.warning(f"Could not resolve a stream for {query}, downloading instead: {e}")
+    if not song:
+        song = await fetch_audio(target, downloads=downloads)
+    song.query = query
+    if search:
+        query_cache.put(query, song)
+    return song
+
+def extract_stream_info(query: str) -> dict:
+    """Resolve a URL or search term to yt-dlp info with a direct audio URL."""
+    opts = {
+        'quiet': True,
+        'format': 'bestaudio/best',
+        'noplaylist': True,
+        'default_search': 'ytsearch',
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(query, download=False)
+    if 'entries' in info:                            # search results
+        info = next((e for e in info['entries'] if e), None)
+        if not info:
+            raise RuntimeError("No results found")
+    if not info.get('url') or not info.get('id'):
+        raise RuntimeError("yt-dlp returned no stream URL")
+    return info
+
+async def resolve_stream(query: str, downloads: dict[str, datetime] | None = None) -> Song:
+    """Resolve a track for streaming and start downloading it in the background."""
+    loop = asyncio.get_running_loop()
+    with resolve_seconds.timer(source_label(query)):
+        info = await loop.run_in_executor(None, extract_stream_info, query)
+    key = f"{(info.get('extractor_key') or 'youtube').lower()}:{info['id']}"
+    entry = track_cache.get(key)
+    if not source_key(query):           # download_audio only counts known IDs
+        cache_requests.inc('track', 'hit' if entry else 'miss')
+    if entry:
+        return Song.from_cache(entry, query)
+
+    song = Song(
+        info.get('title', 'Unknown'),
+        os.path.join(DOWNLOAD_DIR, f"{info['id']}.{info['ext']}"),
+        query, info.get('duration') or 0, key
+    )
+    song.codec = info.get('acodec')
+    song.abr = info.get('abr')
+    song.uploader = info.get('uploader')
+    song.stream_url = info['url']
+    song.http_headers = info.get('http_headers') or {}
+
+    async def background_download():
+        url = info.get('webpage_url') or query
+        try:
+            done = await fetch_audio(url, info.get('format_id') or 'bestaudio/best', downloads)
+        except Exception as e:
+            log.warning(f"Background download failed for {song.title}: {e}")
+            raise
+        song.filepath = done.filepath
+    song.download = asyncio.create_task(background_download())
+    # failures are logged above; keep asyncio from complaining when nobody awaits
+    song.download.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return song
+
+class SharedDownload:
+    """One running download, awaited by every request for the same track."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+shared_downloads: dict[str, SharedDownload] = {}   # source key (or query) -> download
+
+async def fetch_audio(query: str, fmt: str = 'bestaudio/best',
+                      downloads: dict[str, datetime] | None = None) -> Song:
+    """
+    Download a track, or join the download of it that is already running
+    so two requests never write the same file. The download is cancelled
+    once nobody is waiting for it.
+    """
+    key = source_key(query) or query
+    shared = shared_downloads.get(key)
+    first = shared is None
+    if first:
+        shared = shared_downloads[key] = SharedDownload(
+            asyncio.create_task(download_track(query, fmt, downloads)))
+
+        def finished(task: asyncio.Task):
+            if shared_downloads.get(key) is shared:
+                del shared_downloads[key]
+            task.cancelled() or task.exception()
+        shared.task.add_done_callback(finished)
+    else:
+        if downloads is None:
+            downloads = downloads_in_progress
+        downloads[query] = datetime.now()
+    shared.waiters += 1
+    try:
+        done = await asyncio.shield(shared.task)
+    finally:
+        shared.waiters -= 1
+        if not shared.waiters and not shared.task.done():
+            shared.task.cancel()
+        if not first:
+            downloads.pop(query, None)
+    if first:
+        return done
+    song = Song(done.title, done.filepath, query, done.duration, done.key)
+    song.update_from(done)
+    return song
+
+async def download_track(query: str, fmt: str = 'bestaudio/best',
+                         downloads: dict[str, datetime] | None = None) -> Song:
+    """
+    Download a track (YouTube or Spotify), optionally queue an archive of
+    the *raw* file and a *single-pass* Opus encode into the _archive/ tree,
+    and return the Song pointing at the working copy inside DOWNLOAD_DIR.
+    """
+    key = source_key(query)
+    if downloads is None:
+        downloads = downloads_in_progress
+    downloads[query] = datetime.now()
+    started = time.monotonic()
 
     try:
         # ------------------------------------------------------------
         # 1) SPOTIFY (spotDL)
         # ------------------------------------------------------------
-        if re.search(r'https?://(?:open\.)?spotify\.com/track/', query):
-            template  = f"{uuid.uuid4()}.%(ext)s"
-            outfile   = os.path.join(DOWNLOAD_DIR, template)
-            proc      = await asyncio.create_subprocess_exec(
-                'spotdl', query, '--output', outfile,
-                stdout=asyncio.subprocess.DEVNULL,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-            try:
-                await asyncio.wait_for(proc.communicate(), timeout=300)
-            except asyncio.TimeoutError:
-                proc.kill(); await proc.communicate()
-                raise RuntimeError("Spotify download timed out")
-
-            prefix  = os.path.basename(outfile).split('%')[0]
-            entry   = next((x for x in os.listdir(DOWNLOAD_DIR) if x.startswith(prefix)), None)
-            if not entry:
-                raise RuntimeError("spotDL finished but produced no file")
-
-            path = os.path.join(DOWNLOAD_DIR, entry)
-            if os.path.isdir(path):                           # spotDL sometimes makes a folder
-                for root, _, files in os.walk(path):
-                    for f in files:
-                        if f.lower().endswith(('.mp3','.m4a','.flac','.wav','.opus','.ogg')):
-                            path = os.path.join(root, f); break
-            title = os.path.splitext(os.path.basename(path))[0]
-            duration = get_audio_duration(path)
+        if SPOTIFY_TRACK_RE.search(query):
+            track_id = key.split(':', 1)[1]
+            path = await spotify_batcher.fetch(track_id)
+            meta = await probe(path)
+            listed = spotify_listed.get(track_id, {})
+            title = meta['title'] or listed.get('title') or f"Spotify track {track_id}"
+            if meta['title'] and meta['artist']:
+                title = f"{meta['artist']} - {meta['title']}"
+            uploader = meta['artist']
+            duration = meta['duration'] or listed.get('duration') or 0
+            info = {'acodec': meta['codec'], 'abr': meta['abr']}
 
         # ------------------------------------------------------------
         # 2) YOUTUBE (yt-dlp)
         # ------------------------------------------------------------
         else:
-            cmd = [
-                'yt-dlp', '--print-json', '-f', 'bestaudio/best',
-                '-o', os.path.join(DOWNLOAD_DIR, '%(id)s.%(ext)s'), query
-            ]
-            proc = await asyncio.create_subprocess_exec(
-                *cmd, stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL)
-            try:
-                out, _ = await asyncio.wait_for(proc.communicate(), timeout=30)
-            except asyncio.TimeoutError:
-                proc.kill(); await proc.communicate()
-                raise RuntimeError("YouTube download timed out")
-
-            try:
-                info = json.loads(out.decode().splitlines()[-1])
-            except Exception:
-                raise RuntimeError("yt-dlp did not return JSON")
+            report = getattr(downloads, 'report_progress', None)
+            info = await ytdl_pool.download(
+                query, fmt, os.path.join(DOWNLOAD_DIR, '%(id)s.%(ext)s'),
+                (lambda fraction: report(query, fraction)) if report else None)
 
             file_id  = info.get('id');     ext = info.get('ext')
             title    = info.get('title', 'Unknown')
+            uploader = info.get('uploader')
             duration = info.get('duration') or 0
             if not file_id or not ext:
                 raise RuntimeError("yt-dlp returned incomplete data")
+            key = f"{(info.get('extractor_key') or 'youtube').lower()}:{file_id}"
 
-            path = os.path.join(DOWNLOAD_DIR, f"{file_id}.{ext}")
+            path = info.get('filepath') or os.path.join(DOWNLOAD_DIR, f"{file_id}.{ext}")
             if not os.path.isfile(path):
                 raise RuntimeError("yt-dlp finished but file is missing")
             if not duration:
-                duration = get_audio_duration(path)
+                duration = (await probe(path))['duration']
 
-        # ----------------------------------------------------------------
-        # DEBUG / ARCHIVE    keep both *raw* and *encoded* snapshots
-        # ----------------------------------------------------------------
+        # DEBUG / ARCHIVE: keep *raw* and *encoded* snapshots, in the background
         if DEBUG_ARCHIVE:
-            basename = os.path.splitext(os.path.basename(path))[0]
-
-            # 1) raw copy (identical bytes)
-            raw_copy = os.path.join(RAW_DIR, os.path.basename(path))
-            if not os.path.isfile(raw_copy):
-                shutil.copy2(path, raw_copy)
-
-            # 2) single-pass Opus encode at 128k (if not already Opus)
-            enc_copy = os.path.join(ENC_DIR, f"{basename}.opus")
-            if not os.path.isfile(enc_copy):
-                # if the source **is already** Opus we just duplicate it
-                if path.lower().endswith('.opus') or info.get("acodec") == "opus":
-                    shutil.copy2(path, enc_copy)
-                else:
-                    subprocess.run(
-                        ["ffmpeg", "-y", "-i", path,
-                         "-c:a", "libopus", "-b:a", "128k",
-                         "-vn", "-sn", enc_copy],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        check=True
-                    )
+            archive(path, path.lower().endswith('.opus') or info.get("acodec") == "opus")
 
         # The bot itself keeps using the WORKING copy inside DOWNLOAD_DIR
-        return Song(title, path, query, duration)
+        song = Song(title, path, query, duration, key)
+        song.codec = info.get('acodec')
+        song.abr = info.get('abr')
+        song.uploader = uploader
+        download_seconds.observe(time.monotonic() - started, source_label(query))
+        return cache_song(song)
 
     finally:
-        downloads_in_progress.pop(query, None)
+        downloads.pop(query, None)
 
 
 # ---- Voice helper ----
 async def ensure_voice(interaction: discord.Interaction) -> discord.VoiceClient:
+    player = get_player(interaction.guild_id)
     vc = interaction.guild.voice_client
     if vc and vc.is_connected():
         player.voice_client = vc
@@ -390,12 +2548,12 @@ async def ensure_voice(interaction: discord.Interaction) -> discord.VoiceClient:
         raise RuntimeError("You must be in a voice channel.")
     vc = await interaction.user.voice.channel.connect()
     player.voice_client = vc
-    global last_channel_id
-    last_channel_id = interaction.user.voice.channel.id
+    player.last_channel_id = interaction.user.voice.channel.id
+    player.dirty()
     return vc
 
 # ---- Command handler ----
-async def handle_command(cmd: str):
+async def handle_command(player: MusicPlayer, cmd: str):
     vc = player.voice_client
     if not vc:
         return
@@ -414,55 +2572,90 @@ async def handle_command(cmd: str):
     elif cmd == 'loopqueue':
         player.loop_queue = not player.loop_queue
     elif cmd == 'clear':
-        for s in list(player.queue):
-            try: os.remove(s.filepath)
-            except: pass
+        stop_expansions(player)
         player.queue.clear()
+        player.last_playlist = None
+    player.dirty()
+
+async def remove_entry(player: MusicPlayer, entry_id: int) -> bool:
+    """Remove a queued song by its entry ID."""
+    if not player.queue.remove(entry_id):
+        return False
+    prefetch_ahead(player)
+    player.dirty()
+    return True
+
+async def move_entry(player: MusicPlayer, entry_id: int, to_front: bool = True) -> bool:
+    """Move a queued song to the front (play next) or the back of the queue."""
+    if not player.queue.move(entry_id, to_front):
+        return False
+    prefetch_ahead(player)
+    player.dirty()
+    return True
+
+async def remove_origin(player: MusicPlayer, origin: str) -> int:
+    """Remove every queued song with the given origin tag."""
+    stop_expansions(player, origin)
+    removed = len(player.queue.remove_origin(origin))
+    prefetch_ahead(player)
+    player.dirty()
+    return removed
 
-async def remove_at(index: int):
-    """Remove a queued song by its index."""
-    if index < 0 or index >= len(player.queue):
-        return
-    song = player.queue.pop(index)
-    try:
-        os.remove(song.filepath)
-    except Exception:
-        pass
-
-async def remove_last_playlist():
+async def remove_last_playlist(player: MusicPlayer) -> int:
     """Remove songs added by the last playlist command."""
-    global last_playlist_files
-    removed = 0
-    for song in list(player.queue):
-        if song.filepath in last_playlist_files:
-            try:
-                os.remove(song.filepath)
-            except Exception:
-                pass
-            player.queue.remove(song)
-            removed += 1
-    last_playlist_files.clear()
+    if not player.last_playlist:
+        return 0
+    removed = await remove_origin(player, player.last_playlist)
+    player.last_playlist = None
     return removed
 
-async def set_volume(level: int):
-    """Safely adjust playback volume from within the event loop."""
+async def set_volume(player: MusicPlayer, level: int):
+    """Adjust playback volume; the playing source glides to the new level."""
     level = max(0, min(level, 100))
-    async with player.lock:
-        player.volume = level / 100
-        vc = player.voice_client
-        if vc and player.current and (vc.is_playing() or vc.is_paused()):
+    player.volume = level / 100
+    player.dirty()
+    vc = player.voice_client
+    src = player.source
+    if player.upcoming:
+        upcoming = player.upcoming.source
+        if isinstance(upcoming, discord.PCMVolumeTransformer):
+            upcoming.volume = player.volume
+        elif player.volume != 1.0:
+            discard_upcoming(player)    # reopened through PCM
+    if isinstance(src, discord.PCMVolumeTransformer):
+        src.volume = player.volume
+    elif vc and src is not None and vc.source is src and src.is_opus() and player.volume != 1.0:
+        # Opus passthrough has no gain stage: reopen through PCM once, at
+        # the same position; later changes then apply live.
+        async with player.lock:
             pos = player.paused_pos if player.paused_pos is not None else time.time() - player.start_time
             player.paused_pos = pos if vc.is_paused() else None
             player.seek_pos = pos
             vc.stop()
 
-async def seek_to(position: float):
+def request_volume(player: MusicPlayer, level: int):
+    """
+    Set the volume from the HTTP API. Slider drags send a burst of
+    updates; only the last one inside VOLUME_COALESCE_MS is applied.
+    """
+    first = player.pending_volume is None
+    player.pending_volume = level
+    if first:
+        bot.loop.call_later(VOLUME_COALESCE_MS / 1000, apply_pending_volume, player)
+
+def apply_pending_volume(player: MusicPlayer):
+    level, player.pending_volume = player.pending_volume, None
+    if level is not None:
+        bot.loop.create_task(set_volume(player, level))
+
+async def seek_to(player: MusicPlayer, position: float):
     """Safely seek to a position in the current song."""
     if position < 0:
         position = 0
     async with player.lock:
         player.seek_pos = position
         player.start_time = time.time() - position
+        player.dirty()
         vc = player.voice_client
         if vc and (vc.is_playing() or vc.is_paused()):
             was_paused = vc.is_paused() or player.paused_pos is not None
@@ -480,219 +2673,477 @@ async def join(interaction: discord.Interaction):
 
 @bot.tree.command(name='leave', description='Leave the voice channel')
 async def leave(interaction: discord.Interaction):
+    player = get_player(interaction.guild_id)
     vc = interaction.guild.voice_client
     if vc and vc.is_connected():
         await vc.disconnect()
         player.current = None
-        global playback_task
-        playback_task = None
+        player.playback_task = None
+        player.dirty()
         await interaction.response.send_message(" Left the voice channel")
     else:
         await interaction.response.send_message("Not in a voice channel", ephemeral=True)
 
 @bot.tree.command(name='play', description='Play a song or playlist')
 async def play(interaction: discord.Interaction, query: str):
+    player = get_player(interaction.guild_id)
     await interaction.response.defer()
     try:
         await ensure_voice(interaction)
-        if 'list=' in query:
-            await speak("Please wait, downloading playlist this may take a while")
+        is_list = 'list=' in query or SPOTIFY_LIST_RE.search(query)
+        if is_list:
+            await speak(player, "Please wait, downloading playlist this may take a while")
         else:
-            await speak("Please wait, downloading song")
+            await speak(player, "Please wait, downloading song")
 
         m = re.search(r'music\.youtube\.com/playlist\?list=([^&]+)', query)
         if m:
             query = f"https://www.youtube.com/playlist?list={m.group(1)}"
 
-        if re.search(r'https?://(?:open\.)?spotify\.com/track/', query):
-            song = await player.add_song(query)
+        if SPOTIFY_TRACK_RE.search(query):
+            song = await player.add_song(query, f"user:{interaction.user.id}")
             await interaction.followup.send(f" Added **{song.title}** to the queue")
-        elif 'list=' in query:
-            with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': 'in_playlist'}) as ydl:
-                info = ydl.extract_info(query, download=False)
-            entries = info.get('entries') or []
-            added = 0
-            for e in entries:
-                if len(player.queue) >= 10:
-                    break
-                url = e.get('url') or e.get('webpage_url')
-                if not url:
-                    continue
-                if not url.startswith('http'):
-                    url = f"https://www.youtube.com/watch?v={url}"
-                try:
-                    await player.add_song(url)
-                    added += 1
-                except (RuntimeError, IndexError):
-                    break
-            await interaction.followup.send(f" Added **{added}** songs from playlist")
+        elif is_list:
+            job = await add_playlist(player, query)
+            await interaction.followup.send(playlist_message(job))
         else:
-            song = await player.add_song(query)
+            song = await player.add_song(query, f"user:{interaction.user.id}")
             await interaction.followup.send(f" Added **{song.title}** to the queue")
 
-        global playback_task
-        vc = interaction.guild.voice_client
-        if vc and (not playback_task or playback_task.done()):
-            playback_task = bot.loop.create_task(playback_loop(interaction))
+        start_playback(player, interaction)
 
     except Exception as e:
         await interaction.followup.send(str(e), ephemeral=True)
 
+def playlist_message(job: IngestJob) -> str:
+    if job.enqueued:
+        return f" Added **{len(job.songs)}** songs from playlist"
+    return f" Added **{len(job.songs)}** songs from playlist, more are loading"
+
 @bot.tree.command(name='playlist', description='Add all songs from a playlist')
-async def playlist(interaction: discord.Interaction, url: str):
+async def playlist(interaction: discord.Interaction, url: str, shuffle: bool = False,
+                   start: int = 1, end: int | None = None):
+    player = get_player(interaction.guild_id)
     await interaction.response.defer()
     try:
         await ensure_voice(interaction)
-        await speak("Please wait, downloading playlist")
-        songs = await add_playlist(url)
-        await interaction.followup.send(f" Added **{len(songs)}** songs from playlist")
-        global playback_task
-        vc = interaction.guild.voice_client
-        if vc and (not playback_task or playback_task.done()):
-            playback_task = bot.loop.create_task(playback_loop(interaction))
+        await speak(player, "Please wait, downloading playlist")
+        job = await add_playlist(player, url, shuffle=shuffle, start=start, end=end)
+        await interaction.followup.send(playlist_message(job))
+        start_playback(player, interaction)
     except Exception as e:
         await interaction.followup.send(str(e), ephemeral=True)
 
 @bot.tree.command(name='remove_playlist', description='Remove songs added by the last playlist command')
 async def remove_playlist(interaction: discord.Interaction):
-    removed = await remove_last_playlist()
+    player = get_player(interaction.guild_id)
+    removed = await remove_last_playlist(player)
     await interaction.response.send_message(f" Removed {removed} playlist songs")
 
 @bot.tree.command(name='skip', description='Skip the current song')
 async def skip(interaction: discord.Interaction):
-    await handle_command('skip')
+    player = get_player(interaction.guild_id)
+    await handle_command(player, 'skip')
     await interaction.response.send_message(" Skipped")
 
 @bot.tree.command(name='stop', description='Stop playback')
 async def stop(interaction: discord.Interaction):
-    await handle_command('stop')
+    player = get_player(interaction.guild_id)
+    await handle_command(player, 'stop')
     await interaction.response.send_message(" Stopped playback")
 
 @bot.tree.command(name='clear', description='Clear the queue')
 async def clear(interaction: discord.Interaction):
-    await handle_command('clear')
+    player = get_player(interaction.guild_id)
+    await handle_command(player, 'clear')
     await interaction.response.send_message(" Cleared the queue")
 
 @bot.tree.command(name='pause', description='Pause playback')
 async def pause(interaction: discord.Interaction):
-    await handle_command('pause')
+    player = get_player(interaction.guild_id)
+    await handle_command(player, 'pause')
     await interaction.response.send_message(" Paused playback")
 
 @bot.tree.command(name='resume', description='Resume playback')
 async def resume(interaction: discord.Interaction):
-    await handle_command('resume')
+    player = get_player(interaction.guild_id)
+    await handle_command(player, 'resume')
     await interaction.response.send_message(" Resumed playback")
 
 @bot.tree.command(name='loop', description='Toggle loop mode')
 async def loop(interaction: discord.Interaction):
+    player = get_player(interaction.guild_id)
     player.loop = not player.loop
+    player.dirty()
     await interaction.response.send_message(f" Loop is now **{'on' if player.loop else 'off'}**")
 
 @bot.tree.command(name='loopqueue', description='Toggle queue loop mode')
 async def loopqueue(interaction: discord.Interaction):
+    player = get_player(interaction.guild_id)
     player.loop_queue = not player.loop_queue
+    player.dirty()
     await interaction.response.send_message(f" Queue loop is now **{'on' if player.loop_queue else 'off'}**")
 
 @bot.tree.command(name='back', description='Replay the previous song')
 async def back(interaction: discord.Interaction):
+    player = get_player(interaction.guild_id)
     if len(player.history) < 2:
         return await interaction.response.send_message("No previous song", ephemeral=True)
     prev = player.history[-2]
-    if len(player.queue) >= 10:
+    if len(player.queue) >= QUEUE_LIMIT:
         return await interaction.response.send_message("Queue full", ephemeral=True)
-    song = await player.add_song(prev.query)
-    player.queue.insert(0, song)
-    await interaction.response.send_message(f" Replaying **{song.title}**")
-    global playback_task
-    vc = interaction.guild.voice_client
-    if vc and (not playback_task or playback_task.done()):
-        playback_task = bot.loop.create_task(playback_loop(interaction))
+    player.queue.appendleft(Song.pending(prev.query), f"user:{interaction.user.id}")
+    prefetch_ahead(player)
+    player.dirty()
+    await interaction.response.send_message(f" Replaying **{prev.title}**")
+    start_playback(player, interaction)
 
 @bot.tree.command(name='queue', description='Show the queue')
-async def show_queue(interaction: discord.Interaction):
+async def show_queue(interaction: discord.Interaction, page: int = 1):
+    player = get_player(interaction.guild_id)
     if not player.queue:
         return await interaction.response.send_message("The queue is empty", ephemeral=True)
-    listing = "\n".join(f"{i+1}. {s.title}" for i, s in enumerate(player.queue))
-    await interaction.response.send_message(f" Queue:\n{listing}")
+    pages = -(-len(player.queue) // QUEUE_PAGE)
+    page = max(1, min(page, pages))
+    offset = (page - 1) * QUEUE_PAGE
+    listing = "\n".join(f"{offset+i+1}. {s.title}"
+                        for i, s in enumerate(player.queue.page(offset, QUEUE_PAGE)))
+    await interaction.response.send_message(
+        f" Queue (page {page}/{pages}, {len(player.queue)} songs):\n{listing}")
 
 @bot.tree.command(name='volume', description='Set playback volume (0-100)')
 async def volume(interaction: discord.Interaction, level: int):
-    await set_volume(level)
+    player = get_player(interaction.guild_id)
+    await set_volume(player, level)
     await interaction.response.send_message(f" Volume set to {max(0, min(level, 100))}%")
 
 @bot.tree.command(name='status', description='Show status')
 async def status(interaction: discord.Interaction):
+    player = get_player(interaction.guild_id)
     lines = [
         f" Currently playing: {player.current.title if player.current else 'none'}",
         f" Queue length: {len(player.queue)}"
     ]
-    if downloads_in_progress:
+    if player.downloads:
         lines.append(" Downloading:")
-        for q, t in downloads_in_progress.items():
+        for q, t in player.downloads.items():
             elapsed = int((datetime.now() - t).total_seconds())
-            lines.append(f"  {q} ({elapsed}s)")
+            done = player.downloads.progress.get(q)
+            lines.append(f"  {q} ({elapsed}s{f', {done:.0%}' if done is not None else ''})")
     else:
         lines.append(" Downloading: none")
+    stats = query_cache.stats()
+    lines.append(f" Search cache: {stats['hits']} hits, {stats['misses']} misses, "
+                 f"{stats['size']} entries")
+    if DEBUG_ARCHIVE:
+        pending = sum(j.status in ('queued', 'running') for j in archive_jobs.values())
+        failed = sum(j.status == 'failed' for j in archive_jobs.values())
+        lines.append(f" Archive jobs: {pending} pending, {failed} failed")
     await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
+library_commands = discord.app_commands.Group(
+    name='library', description='Tracks already downloaded to this machine')
+
+@library_commands.command(name='search', description='Search the local library')
+async def library_search(interaction: discord.Interaction, query: str):
+    rows = library.search(query)
+    if not rows:
+        return await interaction.response.send_message("No local tracks match", ephemeral=True)
+    lines = []
+    for i, row in enumerate(rows, 1):
+        minutes, seconds = divmod(int(row['duration'] or 0), 60)
+        by = f" – {row['uploader']}" if row['uploader'] else ""
+        lines.append(f"{i}. **{row['title']}**{by} ({minutes}:{seconds:02d})")
+    await interaction.response.send_message(" Library matches:\n" + "\n".join(lines))
+
+bot.tree.add_command(library_commands)
+
 # ---- Playback loop ----
-async def playback_loop(interaction: discord.Interaction | None = None):
-    global playback_task
+def can_passthrough(player: MusicPlayer, song: Song) -> bool:
+    """
+    True when the song's Opus packets can go to Discord as they are:
+    the source is Opus, its bitrate fits the connected channel and there is no
+    gain to apply (gain needs decoded PCM). Loudness corrections under
+    half a decibel aren't worth a transcode.
+    """
+    if song.codec:
+        opus = song.codec == 'opus'
+    else:
+        opus = song.filepath.lower().endswith('.opus')
+    return (opus and (song.abr or 0) <= channel_bitrate(player) and player.volume == 1.0
+            and abs(track_gain_db(song)) < 0.5)
+
+async def open_source(player: MusicPlayer, song: Song,
+                      position: float = 0.0) -> discord.AudioSource:
+    """
+    Open an ffmpeg source for a song, from the local file when it is on
+    disk and from the resolved media URL while it is still downloading.
+
+    Cached tracks with a pre-encoded variant for the channel play that
+    (see ladder_variant). Otherwise Opus sources are remuxed straight
+    through with no transcode; anything else is decoded to PCM so the
+    volume can change while it plays.
+    """
+    seek = f"-ss {position}" if position else ""
+    variant = ladder_variant(player, song)
+    if variant:
+        path, kbps = variant
+        spawns.inc('ffmpeg')
+        song.streaming = False
+        return discord.FFmpegOpusAudio(path, codec='copy', bitrate=kbps,
+                                       before_options=seek or None, options="-vn -sn")
+    if not song.codec and os.path.isfile(song.filepath):
+        meta = await probe(song.filepath)
+        song.codec, song.abr = meta['codec'], song.abr or meta['abr']
+    passthrough = can_passthrough(player, song)
+
+    def make_source(source: str, before: str | None) -> discord.AudioSource:
+        spawns.inc('ffmpeg')
+        if passthrough:
+            return discord.FFmpegOpusAudio(
+                source,
+                codec='copy',
+                bitrate=int(song.abr or 128),
+                before_options=before,
+                options="-vn -sn"
+            )
+        src = discord.FFmpegPCMAudio(source, before_options=before, options="-vn -sn")
+        return RampedVolume(src, player.volume, 10 ** (track_gain_db(song) / 20))
+
+    if not os.path.isfile(song.filepath) and song.stream_url and not song.streaming_failed:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in song.http_headers.items())
+        before = f"{reconnect} {seek}"
+        if headers:
+            before += f" -headers {shlex.quote(headers)}"
+        try:
+            src = make_source(song.stream_url, before)
+            song.streaming = True
+            return src
+        except Exception as e:
+            log.warning(f"Streaming failed for {song.title}, using the download: {e}")
+            song.streaming_failed = True
+    if song.download and not os.path.isfile(song.filepath):
+        await song.download
+    song.streaming = False
+    return make_source(song.filepath, seek or None)
+
+def track_end_callback(player: MusicPlayer):
+    """Build the ``vc.play`` callback for a player; it runs on the audio thread."""
+    def on_track_end(error: Exception | None):
+        player.track_ended_at = time.monotonic()
+        player.play_error = error
+        bot.loop.call_soon_threadsafe(player.play_next.set)
+    return on_track_end
+
+# The next track is opened PREWARM_S before the current one ends. PCM
+# tracks play through a TrackChain that switches to it between two frames;
+# anything else starts it with vc.play as soon as the current one finishes.
+def play_source(player: MusicPlayer, song: Song, src: discord.AudioSource,
+                position: float, after: Callable[[Exception | None], None]):
+    """Start a track's source on the voice client."""
+    player.source = src
+    player.chain = None
+    if not src.is_opus():
+        player.chain = src = TrackChain(
+            song, src, position,
+            lambda upcoming, lead, gap: bot.loop.call_soon_threadsafe(
+                handoff, player, upcoming, lead, gap))
+        if player.upcoming and not player.upcoming.source.is_opus():
+            src.enqueue(player.upcoming)
+    start_audio(player, src, after, bitrate=channel_bitrate(player))
+
+def handoff(player: MusicPlayer, upcoming: UpcomingTrack, lead: float, gap: float):
+    """The chain has switched to the prepared track; let the loop catch up."""
+    track_gap_seconds.observe(gap)
+    if player.upcoming is upcoming:
+        player.upcoming = None
+    player.source = upcoming.source
+    player.handed_off = upcoming.song
+    player.start_time = time.time() - lead
+    player.play_next.set()
+
+def take_upcoming(player: MusicPlayer, song: Song) -> discord.AudioSource | None:
+    """The pre-opened source for ``song``, if it was prepared."""
+    upcoming = player.upcoming
+    if not upcoming or upcoming.song is not song:
+        return None
+    player.upcoming = None
+    if player.chain:
+        player.chain.withdraw(upcoming)
+    if upcoming.intro:
+        upcoming.intro.cleanup()    # a cold start speaks before the track instead
+    return upcoming.source
+
+def discard_upcoming(player: MusicPlayer):
+    """Drop the prepared track after the queue changed under it."""
+    upcoming = player.upcoming
+    if player.chain and not player.chain.withdraw(upcoming):
+        return      # the chain just switched to it; handoff() is on its way
+    player.upcoming = None
+    upcoming.cleanup()
+    schedule_prewarm(player)
+
+def schedule_prewarm(player: MusicPlayer):
+    if player.prewarm_task:
+        player.prewarm_task.cancel()
+        player.prewarm_task = None
+    if player.current:
+        player.prewarm_task = bot.loop.create_task(prewarm(player, player.current))
+
+def time_left(player: MusicPlayer, song: Song) -> float | None:
+    if not song.duration:
+        return None
+    pos = player.paused_pos if player.paused_pos is not None else time.time() - player.start_time
+    return song.duration - pos
+
+async def player_changed(player: MusicPlayer, timeout: float | None = None):
+    """Wait for the player's next touch(), or ``timeout`` seconds."""
+    changed = asyncio.Event()
+    player.watchers.add(changed)
+    try:
+        await asyncio.wait_for(changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        player.watchers.discard(changed)
+
+async def prewarm(player: MusicPlayer, song: Song):
+    """
+    Open the next track's source PREWARM_S before ``song`` ends and queue
+    it on the playing chain. Runs until something is prepared or ``song``
+    is no longer current.
+    """
+    try:
+        while player.current is song and not player.upcoming:
+            left = time_left(player, song)
+            if left is not None and left > PREWARM_S:
+                await asyncio.sleep(left - PREWARM_S)
+                continue
+            nxt = player.next_song()
+            if nxt is None or nxt.resume_at:
+                await player_changed(player)
+                continue
+            if nxt.status != 'ready':
+                await asyncio.shield(prefetch(player, nxt))
+                continue
+            clip = await tts_clip(f"Now playing {nxt.title}")
+            src = await open_source(player, nxt)
+            upcoming = UpcomingTrack(nxt, src)
+            if clip and not src.is_opus():
+                spawns.inc('ffmpeg')
+                upcoming.intro = discord.FFmpegPCMAudio(clip)
+            if player.current is not song or player.next_song() is not nxt:
+                upcoming.cleanup()
+                continue
+            player.upcoming = upcoming
+            chain = player.chain
+            vc = player.voice_client
+            if chain and vc and vc.source is chain and not src.is_opus():
+                chain.enqueue(upcoming)
+    except Exception as e:
+        log.warning(f"Could not prepare the track after {song.title}: {e}")
+
+async def playback_loop(player: MusicPlayer, interaction: discord.Interaction | None = None):
     vc = player.voice_client
     if not vc:
-        playback_task = None
+        player.playback_task = None
         return
+    on_track_end = track_end_callback(player)
     try:
         while True:
             if not vc.is_connected():
                 break
             player.play_next.clear()
-            if not player.queue:
+            song, player.handed_off = player.handed_off, None
+            if song:
+                # the chain is already playing it
+                player.queue.remove(song.entry_id)
+                prefetch_ahead(player)
+                player.history.append(song)
+                player.current = song
+                player.track_ended_at = None    # handoff() measured the gap
+                if song.requested_at is not None:
+                    first_audio_seconds.observe(time.monotonic() - song.requested_at)
+                    song.requested_at = None
+                schedule_prewarm(player)
+                player.dirty()
+                if interaction:
+                    await interaction.followup.send(f" Now playing **{song.title}**")
+            elif not player.queue:
+                player.track_ended_at = None    # idle time isn't a gap
                 if player.current and not vc.is_playing():
                     player.current = None
                     player.start_time = 0.0
-                await asyncio.sleep(1)
-                continue
-            song = player.queue.pop(0)
-            player.history.append(song)
-            player.current = song
-            player.start_time = time.time()
-            try:
-                await speak(f"Now playing {song.title}")
-                bit = channel_bitrate()
-                opts = ffmpeg_options(channel_bitrate())
-                log.debug("FFMPEG OPTS  %s", " ".join(opts))   #  add this
-                src = await discord.FFmpegOpusAudio.from_probe(
-                    song.filepath,
-                    options="-vn -sn"
-                )
-                vc.play(src, after=lambda _: player.play_next.set())
-                if player.paused_pos is not None:
-                    vc.pause()
-                if interaction:
-                    await interaction.followup.send(f" Now playing **{song.title}**")
-            except Exception as e:
-                log.error(f"Playback error for {song.title}: {e}")
+                    schedule_prewarm(player)
+                    player.dirty()
+                await player_changed(player, IDLE_CHECK_S)
                 continue
+            else:
+                song = player.queue.popleft()
+                src = take_upcoming(player, song)
+                prefetch_ahead(player)
+                player.dirty()
+                if song.status != 'ready':
+                    # only block when the head of the queue hasn't landed yet
+                    try:
+                        await prefetch(player, song)
+                    except Exception as e:
+                        log.error(f"Could not load {song.query}: {e}")
+                        continue
+                player.history.append(song)
+                player.current = song
+                player.start_time = time.time()
+                # a track restored from the journal picks up where it stopped
+                pos, song.resume_at = song.resume_at, 0.0
+                try:
+                    if not pos:
+                        await speak(player, f"Now playing {song.title}")
+                    if src is None:
+                        src = await open_source(player, song, pos)
+                    await wait_idle(player)
+                    player.play_error = None
+                    player.start_time = time.time() - pos
+                    play_source(player, song, src, pos, on_track_end)
+                    now = time.monotonic()
+                    if player.track_ended_at is not None:
+                        track_gap_seconds.observe(now - player.track_ended_at)
+                        player.track_ended_at = None
+                    if song.requested_at is not None:
+                        first_audio_seconds.observe(now - song.requested_at)
+                        song.requested_at = None
+                    if player.paused_pos is not None:
+                        vc.pause()
+                    schedule_prewarm(player)
+                    player.dirty()
+                    if interaction:
+                        await interaction.followup.send(f" Now playing **{song.title}**")
+                except Exception as e:
+                    log.error(f"Playback error for {song.title}: {e}")
+                    if src:
+                        src.cleanup()
+                    continue
             await player.play_next.wait()
-            if player.seek_pos is not None:
+            while True:
+                if player.play_error and song.streaming and player.seek_pos is None:
+                    # the stream broke off; carry on from the local copy
+                    log.warning(f"Stream error for {song.title}: {player.play_error}")
+                    song.streaming_failed = True
+                    player.play_error = None
+                    player.seek_pos = time.time() - player.start_time
+                if player.seek_pos is None:
+                    break
                 pos = player.seek_pos
                 player.seek_pos = None
                 player.start_time = time.time() - pos
                 try:
-                    bit = channel_bitrate()
-                    opts = ffmpeg_options(channel_bitrate())
-                    log.debug("FFMPEG OPTS  %s", " ".join(opts))   #  add this
-
-                    src = await discord.FFmpegOpusAudio.from_probe(
-                        song.filepath,
-                        before_options=f' -ss {pos}',
-                        options="-vn -sn"     # audio-only, no extra filters
-                    )
+                    src = await open_source(player, song, pos)
+                    await wait_idle(player)
                     player.play_next.clear()
-                    vc.play(src, after=lambda _: player.play_next.set())
+                    player.play_error = None
+                    play_source(player, song, src, pos, on_track_end)
                     if player.paused_pos is not None:
                         vc.pause()
+                    player.dirty()
                 except Exception as e:
                     log.error(f'Seek error: {e}')
                     player.play_next.set()
@@ -700,155 +3151,424 @@ async def playback_loop(interaction: discord.Interaction | None = None):
             if not player.loop:
                 if player.loop_queue:
                     player.queue.append(song)
-                else:
-                    try:
-                        os.remove(song.filepath)
-                    except Exception:
-                        pass
             else:
-                player.queue.insert(0, song)
+                player.queue.appendleft(song)
+            player.dirty()
     finally:
-        playback_task = None
+        player.playback_task = None
+        if player.prewarm_task:
+            player.prewarm_task.cancel()
+        if player.upcoming:
+            player.upcoming.cleanup()
+            player.upcoming = None
 
 # ---- HTTP server serving external index.html + API ----
-def start_http_server():
-    html_path = os.path.join(os.path.dirname(__file__), 'index.html')
-
-    class AuthHandler(BaseHTTPRequestHandler):
-        def do_AUTHHEAD(self):
-            self.send_response(401)
-            self.send_header('Content-type','application/json')
-            self.end_headers()
-            self.wfile.write(b'{"error":"auth"}')
-
-        def do_GET(self):
-            parsed = urllib.parse.urlparse(self.path)
-            # serve index.html
-            if parsed.path in ('/', '/index.html'):
-                try:
-                    with open(html_path, 'rb') as f:
-                        content = f.read()
-                    self.send_response(200)
-                    self.send_header('Content-type','text/html')
-                    self.send_header('Content-length', str(len(content)))
-                    self.end_headers()
-                    self.wfile.write(content)
-                except FileNotFoundError:
-                    self.send_error(404, 'index.html not found')
-                return
-
-            # require auth for /api
-            if not parsed.path.startswith('/api/'):
-                return self.send_error(404)
-            auth = self.headers.get('Authorization')
-            if not auth or not auth.startswith('Basic '):
-                return self.do_AUTHHEAD()
-            user, pwd = base64.b64decode(auth.split(' ',1)[1]).decode().split(':',1)
-            if user != AUTH_USER or pwd != AUTH_PASS:
-                return self.do_AUTHHEAD()
-
-            cmd = parsed.path[len('/api/'):]
-            params = urllib.parse.parse_qs(parsed.query)
-
-            if cmd in ('skip','stop','pause','resume','clear','loop','loopqueue'):
-                asyncio.run_coroutine_threadsafe(handle_command(cmd), bot.loop)
-            elif cmd == 'add' and 'query' in params:
-                q = params['query'][0]
-                asyncio.run_coroutine_threadsafe(add_and_play(q), bot.loop)
-            elif cmd == 'playlist' and 'url' in params:
-                url = params['url'][0]
-                asyncio.run_coroutine_threadsafe(add_playlist_and_play(url), bot.loop)
-            elif cmd == 'remove_playlist':
-                asyncio.run_coroutine_threadsafe(remove_last_playlist(), bot.loop)
-            elif cmd == 'remove' and 'pos' in params:
-                try:
-                    pos = int(params['pos'][0]) - 1
-                    asyncio.run_coroutine_threadsafe(remove_at(pos), bot.loop)
-                except:
-                    pass
-            elif cmd == 'join' and 'channel' in params:
-                try:
-                    chan = int(params['channel'][0])
-                    asyncio.run_coroutine_threadsafe(join_channel(chan), bot.loop)
-                except:
-                    pass
-            elif cmd == 'seek' and 'pos' in params:
-                try:
-                    pos = float(params['pos'][0])
-                    asyncio.run_coroutine_threadsafe(seek_to(pos), bot.loop)
-                except Exception:
-                    pass
-            elif cmd == 'volume' and 'level' in params:
-                try:
-                    lvl = int(params['level'][0])
-                    asyncio.run_coroutine_threadsafe(set_volume(lvl), bot.loop)
-                except Exception:
-                    pass
-            elif cmd == 'queue':
-                pass
-            else:
-                return self.send_error(400)
-
-            resp = {
-                'current': player.current.title if player.current else None,
-                'queue': [s.title for s in player.queue],
-                'loop': player.loop,
-                'loop_queue': player.loop_queue,
-                'duration': player.current.duration if player.current else 0,
-                'position': (player.paused_pos if player.paused_pos is not None
-                            else (time.time() - player.start_time if player.current else 0)),
-                'volume': int(player.volume * 100),
-                'paused': bool(player.voice_client.is_paused()) if player.voice_client else False,
-            }
-            resp['downloads'] = {
-                q: int((datetime.now() - t).total_seconds())
-                for q, t in downloads_in_progress.items()
+# Runs on the bot's event loop (aiohttp ships with discord.py), so handlers
+# read player state directly instead of from another thread.
+AUTH_HEADER = "Basic " + base64.b64encode(f"{AUTH_USER}:{AUTH_PASS}".encode()).decode()
+HTML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
+
+class StaticFile:
+    """A file served from memory, gzipped once and reloaded when it changes."""
+
+    def __init__(self, path: str, content_type: str):
+        self.path = path
+        self.content_type = content_type
+        self.mtime: float | None = None
+        self.body = self.gzipped = b''
+        self.etag = ''
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self.mtime:
+            with open(self.path, 'rb') as f:
+                self.body = f.read()
+            self.gzipped = gzip.compress(self.body)
+            self.etag = f'"{hashlib.sha1(self.body).hexdigest()[:16]}"'
+            self.mtime = mtime
+
+def cached_response(request: web.Request, body: bytes, gzipped: bytes, etag: str,
+                    content_type: str) -> web.Response:
+    """Reply 304 when the client already has ``etag``, else the (gzipped) body."""
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'X-Server-Time': f"{time.time():.3f}",
+    }
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    headers['Vary'] = 'Accept-Encoding'
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        body = gzipped
+    return web.Response(body=body, headers=headers, content_type=content_type)
+
+def api_guild(params) -> discord.Guild | None:
+    """The guild an API call targets: ``?guild=<id>``, else the first one."""
+    if 'guild' in params:
+        try:
+            return bot.get_guild(int(params['guild']))
+        except ValueError:
+            return None
+    return bot.guilds[0] if bot.guilds else None
+
+def queue_entry(song: Song) -> dict:
+    return {'id': song.entry_id, 'title': song.title, 'status': song.status,
+            'origin': song.origin}
+
+def player_state(player: MusicPlayer, guild: discord.Guild) -> dict:
+    vc = player.voice_client
+    paused = bool(vc.is_paused()) if vc else False
+    return {
+        'current': player.current.title if player.current else None,
+        'queue': [queue_entry(s) for s in player.queue.head(QUEUE_PAGE)],
+        'queue_length': len(player.queue),
+        'loop': player.loop,
+        'loop_queue': player.loop_queue,
+        'duration': player.current.duration if player.current else 0,
+        # clients extrapolate from position_at while not paused
+        'position': (player.paused_pos if player.paused_pos is not None
+                     else (time.time() - player.start_time if player.current else 0)),
+        'position_at': time.time(),
+        'volume': int(player.volume * 100),
+        'paused': paused,
+        'downloads': {q: t.timestamp() for q, t in player.downloads.items()},
+        'download_progress': dict(player.downloads.progress),
+        'ingest': [j.summary() for j in player.ingest_jobs.values()],
+        'guild': str(guild.id),
+        'guilds': {str(g.id): g.name for g in bot.guilds},
+        'channels': {str(cid): name for cid, name in list_voice_channels(guild).items()},
+        'connected': vc.channel.name if vc else None,
+        'query_cache': query_cache.stats(),
+    }
+
+def cached_state(player: MusicPlayer, guild: discord.Guild) -> tuple[dict, bytes, bytes, str]:
+    """The state document, rebuilt only when the player or guild changed."""
+    vc = player.voice_client
+    key = (player.version, len(bot.guilds), tuple(list_voice_channels(guild).items()),
+           bool(vc and vc.is_paused()), vc.channel.id if vc else None)
+    if not player.state_cache or player.state_cache[0] != key:
+        state = player_state(player, guild)
+        body = json.dumps(state).encode()
+        etag = f'"{player.guild_id}-{hashlib.sha1(body).hexdigest()[:16]}"'
+        player.state_cache = (key, state, body, gzip.compress(body), etag)
+    return player.state_cache[1:]
+
+index_file = StaticFile(HTML_PATH, 'text/html')
+
+async def serve_index(request: web.Request) -> web.Response:
+    try:
+        index_file.load()
+    except FileNotFoundError:
+        raise web.HTTPNotFound(text='index.html not found')
+    return cached_response(request, index_file.body, index_file.gzipped,
+                           index_file.etag, index_file.content_type)
+
+def authorized(request: web.Request, query: bool = False) -> bool:
+    """
+    Check the request's Basic credentials. ``query`` also accepts them as
+    ?auth=, for the WebSocket only: browsers cannot set its headers, and
+    anywhere else a password in the URL just ends up in proxy logs.
+    """
+    auth = request.headers.get('Authorization')
+    if not auth and query:
+        auth = 'Basic ' + request.query.get('auth', '')
+    auth = auth or ''
+    # compare bytes: compare_digest rejects str with non-ASCII characters
+    return hmac.compare_digest(auth.encode(), AUTH_HEADER.encode())
+
+def state_delta(old: dict, new: dict) -> dict:
+    """The keys of ``new`` a client holding ``old`` needs to catch up."""
+    delta = {k: v for k, v in new.items()
+             if k not in ('position', 'position_at') and old.get(k) != v}
+    # position is extrapolated client-side; only resend it when that drifts
+    expected = old['position']
+    if old['current'] and not old['paused']:
+        expected += new['position_at'] - old['position_at']
+    if delta.keys() & {'current', 'paused'} or abs(new['position'] - expected) > STREAM_DRIFT_S:
+        delta['position'] = new['position']
+        delta['position_at'] = new['position_at']
+    return delta
+
+async def serve_stream(request: web.Request) -> web.WebSocketResponse:
+    """
+    Push player state over a WebSocket: a snapshot on connect, then a delta
+    holding only the changed keys whenever the player is touched.
+    """
+    if not authorized(request, query=True):
+        return web.json_response({'error': 'auth'}, status=401)
+    guild = api_guild(request.query)
+    if not guild:
+        raise web.HTTPNotFound(text='unknown guild')
+    player = get_player(guild.id)
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    changed = asyncio.Event()
+    player.watchers.add(changed)
+    reader = asyncio.create_task(ws.receive())   # completes when the client goes away
+    try:
+        sent = cached_state(player, guild)[0]
+        await ws.send_json({'type': 'snapshot', 'time': time.time(), 'state': sent})
+        while not ws.closed:
+            waiter = asyncio.create_task(changed.wait())
+            # the timeout also picks up guild/channel changes that don't touch the player
+            await asyncio.wait({waiter, reader}, timeout=STREAM_RESYNC_S,
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if reader.done():
+                break
+            changed.clear()
+            await asyncio.sleep(STREAM_COALESCE_MS / 1000)
+            state = cached_state(player, guild)[0]
+            delta = state_delta(sent, state)
+            if delta:
+                await ws.send_json({'type': 'delta', 'time': time.time(), 'state': delta})
+                sent = state
+    finally:
+        player.watchers.discard(changed)
+        reader.cancel()
+    return ws
+
+async def serve_api(request: web.Request) -> web.Response:
+    if not authorized(request):
+        return web.json_response({'error': 'auth'}, status=401)
+    params = request.query
+    guild = api_guild(params)
+    if not guild:
+        raise web.HTTPNotFound(text='unknown guild')
+    player = get_player(guild.id)
+    cmd = request.match_info['cmd']
+    job = None
+
+    if cmd in ('skip','stop','pause','resume','clear','loop','loopqueue'):
+        await handle_command(player, cmd)
+    elif cmd == 'add' and 'query' in params:
+        q = params['query']
+        job = new_ingest_job(player, q, [q])
+        bot.loop.create_task(add_and_play(player, q, job))
+    elif cmd == 'playlist' and 'url' in params:
+        url = params['url']
+        try:
+            options = {
+                'shuffle': params.get('shuffle') == '1',
+                'start': int(params.get('start', 1)),
+                'end': int(params['end']) if params.get('end') else None,
             }
-            resp['channels'] = {str(cid): name for cid, name in list_voice_channels().items()}
-            resp['connected'] = player.voice_client.channel.name if player.voice_client else None
-            data = json.dumps(resp).encode()
-            self.send_response(200)
-            self.send_header('Content-type','application/json')
-            self.send_header('Content-length', str(len(data)))
-            self.end_headers()
-            self.wfile.write(data)
-
-    server = HTTPServer(('0.0.0.0', HTTP_CONTROL_PORT), AuthHandler)
-    threading.Thread(target=server.serve_forever, daemon=True).start()
+        except ValueError:
+            raise web.HTTPBadRequest()
+        job = new_ingest_job(player, url)
+        bot.loop.create_task(add_playlist_and_play(player, url, job, **options))
+    elif cmd == 'remove_playlist':
+        await remove_last_playlist(player)
+    elif cmd == 'remove' and 'id' in params:
+        try:
+            await remove_entry(player, int(params['id']))
+        except ValueError:
+            pass
+    elif cmd == 'remove' and 'origin' in params:
+        await remove_origin(player, params['origin'])
+    elif cmd == 'move' and 'id' in params:
+        try:
+            await move_entry(player, int(params['id']), params.get('to', 'front') == 'front')
+        except ValueError:
+            pass
+    elif cmd == 'join' and 'channel' in params:
+        try:
+            bot.loop.create_task(join_channel(player, int(params['channel'])))
+        except ValueError:
+            pass
+    elif cmd == 'seek' and 'pos' in params:
+        try:
+            await seek_to(player, float(params['pos']))
+        except ValueError:
+            pass
+    elif cmd == 'volume' and 'level' in params:
+        try:
+            request_volume(player, int(params['level']))
+        except ValueError:
+            pass
+    elif cmd == 'archive':
+        return web.json_response({'archive': [j.summary() for j in archive_jobs.values()]})
+    elif cmd == 'library' and 'q' in params:
+        try:
+            limit = max(1, min(int(params.get('limit', LIBRARY_RESULTS)), 100))
+        except ValueError:
+            raise web.HTTPBadRequest()
+        rows = library.search(params['q'], limit)
+        return web.json_response({'query': params['q'], 'results': [library_entry(r) for r in rows]})
+    elif cmd == 'job' and 'id' in params:
+        ingest_job = player.ingest_jobs.get(params['id'])
+        if not ingest_job:
+            raise web.HTTPNotFound(text='unknown job')
+        try:
+            offset = max(0, int(params.get('offset', 0)))
+            limit = max(1, min(int(params.get('limit', QUEUE_PAGE)), 500))
+        except ValueError:
+            raise web.HTTPBadRequest()
+        return web.json_response({
+            **ingest_job.summary(),
+            'offset': offset,
+            'tracks': ingest_job.tracks(offset, limit),
+        })
+    elif cmd == 'queue' and ('offset' in params or 'limit' in params):
+        try:
+            offset = max(0, int(params.get('offset', 0)))
+            limit = max(1, min(int(params.get('limit', QUEUE_PAGE)), 500))
+        except ValueError:
+            raise web.HTTPBadRequest()
+        return web.json_response({
+            'offset': offset,
+            'total': len(player.queue),
+            'entries': [queue_entry(s) for s in player.queue.page(offset, limit)],
+        })
+    elif cmd == 'queue':
+        state, body, gzipped, etag = cached_state(player, guild)
+        return cached_response(request, body, gzipped, etag, 'application/json')
+    else:
+        raise web.HTTPBadRequest()
+
+    state = cached_state(player, guild)[0]
+    if job:
+        state = {**state, 'job': job.id}
+    return web.json_response(state)
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    if not authorized(request):
+        return web.json_response({'error': 'auth'}, status=401)
+    return web.Response(text=render_metrics(), content_type='text/plain',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+@web.middleware
+async def time_requests(request: web.Request, handler):
+    started = time.monotonic()
+    received = time.time()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical if resource else 'unmatched'
+        if endpoint == '/api/{cmd}' and status < 400:
+            endpoint = f"/api/{request.match_info['cmd']}"   # only known commands succeed
+        if endpoint != '/api/ws':       # a stream, not a request
+            http_seconds.observe(time.monotonic() - started, endpoint)
+            spans.record('http', endpoint, received, status=status)
+
+async def serve_traces(request: web.Request) -> web.Response:
+    if not authorized(request):
+        return web.json_response({'error': 'auth'}, status=401)
+    return web.json_response({
+        'slow': list(spans.slow_spans),
+        'recent': list(spans.recent)[-50:],
+        'stalls': list(watchdog.stalls),
+    })
+
+def make_http_app() -> web.Application:
+    app = web.Application(middlewares=[time_requests])
+    app.router.add_get('/', serve_index)
+    app.router.add_get('/index.html', serve_index)
+    app.router.add_get('/metrics', serve_metrics)
+    app.router.add_get('/debug/traces', serve_traces)
+    app.router.add_get('/api/ws', serve_stream)
+    app.router.add_get('/api/{cmd}', serve_api)
+    return app
+
+async def start_http_server():
+    runner = web.AppRunner(make_http_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', HTTP_CONTROL_PORT).start()
     log.info(f"HTTP control (auth) on port {HTTP_CONTROL_PORT}")
 
 # ---- Bot events & cleanup ----
+state_restored = False     # on_ready runs again after every reconnect
+
+@bot.event
+async def setup_hook():
+    watchdog.start(bot.loop)
+    bot.loop.create_task(ytdl_pool.start())
+    if DEBUG_ARCHIVE:
+        start_archive_workers()
+    if NORMALIZE:
+        start_loudness_workers()
+    if OPUS_LADDER:
+        start_ladder_workers()
+    bot.loop.create_task(rebuild_library())
+    shutil.rmtree(SPOTIFY_DIR, ignore_errors=True)     # runs cut short by a restart
+    await start_http_server()
+
 @bot.event
 async def on_ready():
+    global state_restored
     log.info(f"Logged in as {bot.user} (ID: {bot.user.id})")
     await bot.tree.sync()
-    periodic_cleanup.start()
+    if not state_restored:
+        # restore before the first cleanup so queued files aren't evicted
+        state_restored = True
+        os.makedirs(STATE_DIR, exist_ok=True)
+        for guild in bot.guilds:
+            try:
+                await restore_player(guild)
+            except Exception as e:
+                log.warning(f"Could not restore guild {guild.id}: {e}")
+        periodic_cleanup.start()
+        journal_positions.start()
+    bot.loop.create_task(prerender_prompts())
+
+# command spans start when Discord created the interaction, so they
+# include gateway delay as well as our own handling
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    spans.record('command', command.qualified_name, interaction.created_at.timestamp(),
+                 guild=interaction.guild_id)
 
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error):
-    log.error(f"Error in {interaction.command.name}: {error}")
+    name = interaction.command.name if interaction.command else 'unknown'
+    spans.record('command', name, interaction.created_at.timestamp(),
+                 error=str(error), guild=interaction.guild_id)
+    log.error(f"Error in {name}: {error}")
     if isinstance(error, RuntimeError):
         await interaction.response.send_message(str(error), ephemeral=True)
 
+@tasks.loop(seconds=15)
+async def journal_positions():
+    # the position moves without touching the player; keep the journal close
+    for player in players.values():
+        if player.current and player.paused_pos is None and not player.journal_handle:
+            journal_player(player)
+
 @tasks.loop(hours=1)
 async def periodic_cleanup():
+    pinned = in_use_paths()
+    evicted = track_cache.evict(pinned)
+    # Anything the cache doesn't know about is a leftover (partial download,
+    # stray TTS clip); drop it once it is older than the retention window.
     cutoff = datetime.now() - timedelta(hours=FILE_RETENTION_HOURS)
-    removed = 0
+    tracked = track_cache.paths() | pinned | {CACHE_INDEX, PROBE_INDEX}
+    tracked |= {LIBRARY_DB + suffix for suffix in ('', '-journal', '-wal', '-shm')}
+    removed = sweep_ladder_parts()
     for fname in os.listdir(DOWNLOAD_DIR):
         path = os.path.join(DOWNLOAD_DIR, fname)
-        if os.path.isfile(path) and datetime.fromtimestamp(os.path.getmtime(path)) < cutoff:
+        if path in tracked or not os.path.isfile(path):
+            continue
+        if datetime.fromtimestamp(os.path.getmtime(path)) < cutoff:
             try:
                 os.remove(path)
                 removed += 1
             except:
                 pass
-    if removed:
-        log.info(f"Cleaned up {removed} old files")
+    if evicted or removed:
+        log.info(f"Evicted {evicted} cached tracks, cleaned up {removed} stray files")
 
 # ---- Entrypoint ----
 if __name__ == '__main__':
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-    start_http_server()
     token = os.environ.get('DISCORD_TOKEN', 'discordtoken')
     if not token:
         log.error('DISCORD_TOKEN not set'); sys.exit(1)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Long-lived yt-dlp download worker used by bot.py.
+
+Reads one JSON job per line on stdin and answers on stdout with JSON
+lines tagged with the job id: any number of ``progress`` messages, then
+exactly one ``done`` (with the track info) or ``error``. yt-dlp is
+imported once, so jobs skip interpreter startup and extractor setup.
+"""
+import json
+import os
+import sys
+import time
+
+import yt_dlp
+
+PROGRESS_INTERVAL = 0.5   # seconds between progress messages
+
+# yt-dlp and the processes it starts (ffmpeg) may print to stdout; keep
+# the protocol channel to ourselves and point fd 1 at stderr
+out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+os.dup2(sys.stderr.fileno(), 1)
+sys.stdout = sys.stderr
+
+
+def send(msg: dict):
+    out.write(json.dumps(msg) + "\n")
+
+
+def run(job: dict):
+    last = 0.0
+
+    def hook(d: dict):
+        nonlocal last
+        now = time.monotonic()
+        if d.get('status') == 'downloading' and now - last >= PROGRESS_INTERVAL:
+            last = now
+            send({
+                'id': job['id'],
+                'type': 'progress',
+                'downloaded': d.get('downloaded_bytes') or 0,
+                'total': d.get('total_bytes') or d.get('total_bytes_estimate') or 0,
+            })
+
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'noplaylist': True,
+        'format': job.get('format') or 'bestaudio/best',
+        'default_search': 'ytsearch',
+        'outtmpl': job['outtmpl'],
+        'progress_hooks': [hook],
+    }
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(job['url'], download=True)
+    if 'entries' in info:                            # search results
+        info = next((e for e in info['entries'] if e), None)
+        if not info:
+            raise RuntimeError("No results found")
+    downloads = info.get('requested_downloads') or [{}]
+    send({
+        'id': job['id'],
+        'type': 'done',
+        'info': {
+            'id': info.get('id'),
+            'ext': info.get('ext'),
+            'title': info.get('title'),
+            'uploader': info.get('uploader'),
+            'duration': info.get('duration'),
+            'extractor_key': info.get('extractor_key'),
+            'acodec': info.get('acodec'),
+            'abr': info.get('abr'),
+            'filepath': downloads[0].get('filepath'),
+        },
+    })
+
+
+def main():
+    send({'type': 'ready'})
+    for line in sys.stdin:
+        try:
+            job = json.loads(line)
+        except ValueError:
+            continue
+        try:
+            run(job)
+        except BaseException as e:          # yt-dlp raises SystemExit on some errors
+            send({'id': job.get('id'), 'type': 'error', 'error': str(e) or type(e).__name__})
+
+
+if __name__ == '__main__':
+    main()